@@ -25,7 +25,8 @@ class EmailEntrySerializer(serializers.HyperlinkedModelSerializer):
         fields = ('url', 'id', 'kind_name', 'kind_language', 'send_at', 'sent',
                   'customer_id', 'sender', 'recipients', 'subject', 'reply_to',
                   'thirdparty_id', 'datetime_sent', 'check_url', 'deleted',
-                  'attachments', 'render_link', 'datetime_scheduled', 'is_spam')
+                  'attachments', 'render_link', 'datetime_scheduled', 'is_spam',
+                  'status')
 
     @staticmethod
     def _render_link(obj):
@@ -0,0 +1,36 @@
+"""
+Connections to the queue system, shared by its consumers and publishers.
+"""
+import pika
+
+from django.conf import settings
+
+
+def connect():
+    """Opens a blocking connection to RabbitMQ as configured in the settings"""
+    return pika.BlockingConnection(
+        pika.ConnectionParameters(
+            host=settings.RABBITMQ_HOST,
+            port=settings.RABBITMQ_PORT,
+            virtual_host=settings.RABBITMQ_VHOST,
+            credentials=pika.PlainCredentials(
+                username=settings.RABBITMQ_USERNAME,
+                password=settings.RABBITMQ_PASSWORD
+            ),
+            connection_attempts=settings.RABBITMQ_CONNECTION_ATTEMPTS,
+            heartbeat_interval=settings.RABBITMQ_HEARTBEAT_INTERVAL,
+            socket_timeout=1
+        )
+    )
+
+
+def bind_queue(channel, queue):
+    """Binds the queue to the email exchange, declaring both in DEBUG"""
+    if settings.DEBUG:
+        # Declare the queue topology in a dev/test environment.
+        channel.exchange_declare(exchange=settings.RABBITMQ_EMAIL_EXCHANGE,
+                                 durable=True, passive=settings.RABBITMQ_PASSIVE)
+        channel.queue_declare(queue=queue,
+                              durable=True, passive=settings.RABBITMQ_PASSIVE)
+
+    channel.queue_bind(exchange=settings.RABBITMQ_EMAIL_EXCHANGE, queue=queue)
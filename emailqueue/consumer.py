@@ -3,13 +3,13 @@ This module manages the message consumtion from the queue system.
 Current consumers are:
 - Enqueue Email: Use to enqueue new emails.
 """
-import pika
 import json
 import logging
 
 from django.conf import settings
 
 from emails.schedule import schedule
+from emailqueue.connection import connect, bind_queue
 from custom.stats import increment
 
 
@@ -43,31 +43,9 @@ def on_enqueue_email(channel, method_frame, header_frame, body):
 
 def send_email_consumer():
     try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=settings.RABBITMQ_HOST,
-                port=settings.RABBITMQ_PORT,
-                virtual_host=settings.RABBITMQ_VHOST,
-                credentials=pika.PlainCredentials(
-                    username=settings.RABBITMQ_USERNAME,
-                    password=settings.RABBITMQ_PASSWORD
-                ),
-                connection_attempts=settings.RABBITMQ_CONNECTION_ATTEMPTS,
-                heartbeat_interval=settings.RABBITMQ_HEARTBEAT_INTERVAL,
-                socket_timeout=1
-            )
-        )
+        connection = connect()
         channel = connection.channel()
-
-        if settings.DEBUG:
-            # Declare the queue topology in a dev/test environment.
-            channel.exchange_declare(exchange=settings.RABBITMQ_EMAIL_EXCHANGE,
-                                     durable=True, passive=settings.RABBITMQ_PASSIVE)
-            channel.queue_declare(queue=settings.RABBITMQ_ENQUEUE_EMAIL_QUEUE,
-                                  durable=True, passive=settings.RABBITMQ_PASSIVE)
-
-        channel.queue_bind(exchange=settings.RABBITMQ_EMAIL_EXCHANGE,
-                           queue=settings.RABBITMQ_ENQUEUE_EMAIL_QUEUE)
+        bind_queue(channel, settings.RABBITMQ_ENQUEUE_EMAIL_QUEUE)
     except Exception as e:
         logger.exception('Exception occurred while connecting to RabbitMQ')
         raise e
@@ -0,0 +1,125 @@
+"""
+The send queue tells the senders that an entry is due, or will be soon, so
+they do not have to poll the database to find it. Its messages are only
+hints carrying the entry id and due time: the database is still the source
+of truth, and the senders sweep it every `SENDER_SWEEP_SECONDS` for
+anything a lost message left behind.
+"""
+import json
+import time
+import logging
+import threading
+
+from django.conf import settings
+
+from emails.utils import now_timestamp
+from emailqueue.connection import connect, bind_queue
+
+
+logger = logging.getLogger('emails')
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def publish_send(entry_id, due_at):
+    """
+    Publishes the id and due time of an entry to the send queue. The
+    connection is idle between entries, so the broker may have dropped it
+    for missing heartbeats: on an error it is opened again and the message
+    published once more. A message that still cannot be published is only
+    logged, as the entry will be found by the next sweep anyway.
+    """
+    body = json.dumps({'id': entry_id, 'due_at': due_at})
+    with _publisher_lock:
+        for retry in (True, False):
+            try:
+                _publish(body)
+                return
+            except Exception as e:
+                _close_publisher()
+                if not retry:
+                    logger.warning('Could not publish entry {id} to the send queue: {e!r}'
+                                   .format(id=entry_id, e=e))
+
+
+def _publish(body):
+    global _publisher
+    if _publisher is None:
+        connection = connect()
+        channel = connection.channel()
+        bind_queue(channel, settings.RABBITMQ_SEND_EMAIL_QUEUE)
+        _publisher = (connection, channel)
+    _publisher[1].basic_publish(
+        exchange=settings.RABBITMQ_EMAIL_EXCHANGE,
+        routing_key=settings.RABBITMQ_SEND_EMAIL_QUEUE,
+        body=body
+    )
+
+
+def _close_publisher():
+    global _publisher
+    if _publisher is not None:
+        _close(_publisher[0])
+    _publisher = None
+
+
+class SendQueueListener(object):
+    """
+    Waits for the entries published to the send queue. The entries not due
+    yet go to the timing wheel of the sender. Messages are consumed without
+    ack, as losing one only delays its entry until the next sweep.
+    @type wheel: emails.wheel.TimingWheel
+    """
+
+    def __init__(self, wheel):
+        self.wheel = wheel
+        self.connection = connect()
+        channel = self.connection.channel()
+        bind_queue(channel, settings.RABBITMQ_SEND_EMAIL_QUEUE)
+        channel.basic_consume(self._on_message,
+                              queue=settings.RABBITMQ_SEND_EMAIL_QUEUE,
+                              no_ack=True)
+        self._messages = 0
+        self._due = 0
+
+    def wait(self, timeout):
+        """
+        Blocks until some entries are published or `timeout` seconds pass.
+        Returns how many of the entries received are already due,
+        including those that were waiting in the queue.
+        """
+        self._messages = self._due = 0
+        deadline = time.time() + timeout
+        while not self._messages:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.connection.process_data_events(time_limit=remaining)
+        self.connection.process_data_events(time_limit=0)
+        return self._due
+
+    def close(self):
+        _close(self.connection)
+
+    def _on_message(self, channel, method_frame, header_frame, body):
+        self._messages += 1
+        try:
+            message = json.loads(body.decode('utf8'))
+            entry_id, due_at = int(message['id']), int(message['due_at'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Wrong message in the send queue: {}'.format(body))
+            return
+        if due_at > now_timestamp():
+            self.wheel.add(entry_id, due_at)
+        else:
+            self._due += 1
+
+
+def _close(connection):
+    if connection is None:
+        return
+    try:
+        connection.close()
+    except Exception:
+        logger.exception('Error closing a connection to RabbitMQ')
@@ -14,6 +14,7 @@ from .models import EmailKind, EmailEntry, Attachment, EmailKindFragment
 from .models import EmbeddedImage, FragmentEmbeddedImage
 from .render import render_html, render_plain
 from .send import send
+from .utils import now_timestamp
 
 
 logger = logging.getLogger('admin')
@@ -33,13 +34,14 @@ class FragmentEmbeddedImageInline(admin.TabularInline):
 
 
 FRAGMENTS_DESCRIPTION = mark_safe("""If an email kind fragment is included it can be referenced
-with referenced with <b>{{ fragments.name }}</b>, where <i>name</i> is the fragment name.""")
+with <b>{% include "name" %}</b>, or <b>{{ fragments.name }}</b>, where <i>name</i> is the
+fragment name. Its macros can be imported with <b>{% import "name" as name %}</b>.""")
 
 
 class EmailKindAdmin(admin.ModelAdmin):
     fieldsets = [
         (None, {'fields': ['name', 'language', 'description']}),
-        (None, {'fields': ['active']}),
+        (None, {'fields': ['active', 'priority', 'check_batch_url']}),
         ('Templates', {'fields': ['template', 'plain_template']}),
         ('Defaults', {'fields': [
             'default_context', 'default_sender', 'default_recipients',
@@ -49,7 +51,7 @@ class EmailKindAdmin(admin.ModelAdmin):
     ]
     inlines = [EmbeddedImageInline]
     filter_horizontal = ('fragments',)
-    list_filter = ('active',)
+    list_filter = ('active', 'priority')
     search_fields = ['name']
 
 
@@ -84,15 +86,26 @@ class EmailKindFragmentAdmin(admin.ModelAdmin):
 
 class EmailEntryAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'datetime_sent')
-    readonly_fields = ('kind', 'send_at', 'sent', 'is_spam', 'customer_id',
+    readonly_fields = ('kind', 'priority', 'send_at', 'status', 'due_at',
+                       'lease_owner', 'lease_expires_at', 'attempts', 'last_error',
+                       'next_attempt_at', 'sent', 'is_spam', 'customer_id',
                        'sender', 'recipients', 'subject', 'reply_to',
                        'backend', 'thirdparty_id', 'thirdparty_reject',
                        'check_url', 'deleted', 'datetime_sent',
-                       'datetime_scheduled')
+                       'datetime_scheduled', 'rendered_kind_version')
 
-    list_filter = ('sent', 'is_spam')
+    list_filter = ('status', 'sent', 'is_spam')
     search_fields = ['kind__name', 'customer_id', 'recipients', 'subject',
                      'thirdparty_id']
+    actions = ['retry_quarantined']
+
+    def retry_quarantined(self, request, queryset):
+        count = queryset.filter(status=EmailEntry.STATUS_QUARANTINED)\
+                        .update(status=EmailEntry.STATUS_PENDING,
+                                attempts=0, next_attempt_at=None,
+                                due_at=now_timestamp())
+        self.message_user(request, '{} entries will be sent again'.format(count))
+    retry_quarantined.short_description = 'Retry the selected quarantined entries'
 
 
 admin.site.register(EmailKind, EmailKindAdmin)
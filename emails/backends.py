@@ -1,42 +1,245 @@
+import time
 import logging
+import threading
 from django.conf import settings
+from django.core.mail import get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils import timezone
 
 from custom import import_from_module
+from custom.stats import increment
+from emails.models import EmailEntry
+from emails.utils import bulk_update
+from emails.throttle import RateLimiter
+from emails.concurrency import record_send
 
 
 logger = logging.getLogger('emails')
 
+_backends = {}
+_backends_lock = threading.Lock()
+
+
 def send_with_backend(email, entry):
-    default = settings.CUSTOM_DEFAULT_EMAIL_BACKEND
-    name = entry.backend if entry.backend else default
-    settings.EMAIL_BACKEND, rmanager = _get_backend(name)
-    email.send()
+    name = entry.backend if entry.backend else settings.CUSTOM_DEFAULT_EMAIL_BACKEND
+    backend = get_backend(name)
+    connection = backend.acquire()
+    broken = False
+    try:
+        email.connection = connection
+        backend.throttle(1)
+        try:
+            email.send()
+        except Exception:
+            broken = True
+            raise
+    finally:
+        backend.release(connection, broken)
+
+    sent = backend.response_manager.process_response(email, entry)
+    _record_result(email, entry, sent, name)
+    return sent
+
+
+def send_batch_with_backend(name, emails, entries):
+    """
+    Sends all the emails with a single `send_messages` call of the named
+    backend, and lets its response manager map each result back to the
+    entry of the email. Returns a list telling for each entry if its email
+    was sent.
+
+    If the backend fails halfway, the emails it handled before failing
+    still get their results recorded. Results are written with one UPDATE
+    for every outcome: sent, rejected and spam. Failed entries are left
+    for the caller to retry.
+    @type emails: list of EmailMultiAlternatives
+    @type entries: list of EmailEntry, in the same order as emails
+    """
+    backend = get_backend(name)
+    connection = backend.acquire()
+    broken = False
+    try:
+        for email in emails:
+            email.connection = connection
+        backend.throttle(len(emails))
+        started = time.time()
+        try:
+            connection.send_messages(emails)
+        except Exception:
+            logger.exception("Error sending a batch of {n} emails by backend {name}"\
+                             .format(n=len(emails), name=name))
+            broken = True
+        elapsed = time.time() - started
+    finally:
+        backend.release(connection, broken)
+
+    sent_list = _process_responses(backend.response_manager, emails, entries)
+    by_status = {}
+    now = timezone.now()
+    for email, entry, sent in zip(emails, entries, sent_list):
+        _set_result(email, entry, sent, name, now)
+        by_status.setdefault(entry.status, []).append(entry)
+    if emails:
+        # Rejections are answers of the backend, only the rest are errors
+        errors = len(by_status.get(EmailEntry.STATUS_SENDING, []))
+        record_send(elapsed / len(emails), errors / len(emails))
+    bulk_update(by_status.get(EmailEntry.STATUS_SENT, []), EmailEntry.SENT_FIELDS)
+    for status in (EmailEntry.STATUS_REJECTED, EmailEntry.STATUS_SPAM):
+        bulk_update(by_status.get(status, []), EmailEntry.RESULT_FIELDS)
+    return sent_list
+
 
-    sent = rmanager.process_response(email, entry)
+def _process_responses(response_manager, emails, entries):
+    """
+    Processes the responses of the emails with the response manager. Those
+    not based on BaseResponseManager may lack `process_responses`, and
+    have every response processed with `process_response` instead, as
+    the emails are already sent by now.
+    """
+    if hasattr(response_manager, 'process_responses'):
+        return response_manager.process_responses(emails, entries)
+    return BaseResponseManager.process_responses(response_manager, emails, entries)
+
+
+def _record_result(email, entry, sent, name):
+    _set_result(email, entry, sent, name, timezone.now())
+    entry.save(update_fields=EmailEntry.SENT_FIELDS if sent else EmailEntry.RESULT_FIELDS)
+
+
+def _set_result(email, entry, sent, name, now):
     if sent:
         entry.sent = True
-        entry.datetime_sent = timezone.now()
+        entry.status = EmailEntry.STATUS_SENT
+        entry.datetime_sent = now
         entry.rendered_template = email.alternatives[0][0]
         entry.rendered_plain_template = email.body
     else:
+        if entry.is_spam:
+            entry.status = EmailEntry.STATUS_SPAM
+        elif entry.thirdparty_reject:
+            entry.status = EmailEntry.STATUS_REJECTED
         logger.error("Rejected email {id} by backend {name}"\
                      .format(id=entry.id, name=name))
-    entry.save()
-    settings.EMAIL_BACKEND = None
-    return sent
 
-def _get_backend(name):
+
+def get_backend(name):
+    """
+    Returns the Backend configured with that name in
+    `CUSTOM_EMAIL_BACKENDS`. It is resolved the first time it is asked
+    for. Later calls, from any thread, share it.
+    """
+    backend = _backends.get(name)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(name)
+            if backend is None:
+                backend = _backends[name] = _resolve_backend(name)
+    return backend
+
+
+def close_backends():
+    """Closes the connections of all the resolved backends and forgets them"""
+    with _backends_lock:
+        for backend in _backends.values():
+            backend.close()
+        _backends.clear()
+
+
+@receiver(setting_changed)
+def _reset_backends(setting, **kwargs):
+    if setting in ('CUSTOM_EMAIL_BACKENDS', 'CUSTOM_DEFAULT_EMAIL_BACKEND'):
+        close_backends()
+
+
+def _resolve_backend(name):
     for backend_tuple in settings.CUSTOM_EMAIL_BACKENDS:
         if backend_tuple[0] == name:
             backend_path = backend_tuple[1]
-            response_manager_path = backend_tuple[2]
-            response_manager = import_from_module(response_manager_path)()
-            return (backend_path, response_manager)
+            response_manager = import_from_module(backend_tuple[2])()
+            options = backend_tuple[3] if len(backend_tuple) > 3 else {}
+            return Backend(name, backend_path, response_manager, **options)
     else:
         raise Exception('backend with name: {} not found'.format(name))
 
 
+class Backend(object):
+    """
+    An email backend of `CUSTOM_EMAIL_BACKENDS` with its long-lived
+    connections and its response manager. With a `rate`, in messages per
+    second, its sending is paced by a RateLimiter shared by all the
+    senders, which lets `burst` messages go at once.
+
+    Connections are not safe to use from several threads at once, so every
+    send acquires one for itself. Released connections are kept open for
+    the next sends, so there are as many as threads sending at once. Those
+    idle for more than `SENDER_CONNECTION_IDLE_SECONDS` are closed instead
+    of reused, as the server may have dropped them meanwhile.
+    """
+
+    def __init__(self, name, backend_path, response_manager, rate=None, burst=None):
+        self.name = name
+        self.backend_path = backend_path
+        self.response_manager = response_manager
+        self.limiter = None
+        if rate:
+            self.limiter = RateLimiter('backend:{}'.format(name), rate, burst)
+        self._idle = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Returns an open connection for the current thread alone"""
+        oldest = time.time() - settings.SENDER_CONNECTION_IDLE_SECONDS
+        with self._lock:
+            expired = [connection for connection, since in self._idle if since < oldest]
+            self._idle = [(connection, since) for connection, since in self._idle
+                          if since >= oldest]
+            connection = self._idle.pop()[0] if self._idle else None
+        for expired_connection in expired:
+            self._close(expired_connection)
+        if connection is None:
+            connection = get_connection(self.backend_path)
+            connection.open()
+        return connection
+
+    def throttle(self, count):
+        """Waits until `count` messages can be sent within the rate limit"""
+        if self.limiter is None:
+            return
+        waited = self.limiter.wait(count)
+        if waited:
+            increment(settings.METRIC['SEND_THROTTLED'])
+            logger.info('Backend {name} throttled for {s:.2f}s'.format(name=self.name, s=waited))
+
+    def release(self, connection, broken=False):
+        """
+        Gives back an acquired connection to be reused. A connection that
+        may have been broken by an error is closed instead, and so are
+        those released once the backend is closed.
+        """
+        with self._lock:
+            if not broken and not self._closed:
+                self._idle.append((connection, time.time()))
+                return
+        self._close(connection)
+
+    def close(self):
+        """Closes the idle connections, and those in use when released"""
+        with self._lock:
+            self._closed = True
+            connections = [connection for connection, _ in self._idle]
+            self._idle = []
+        for connection in connections:
+            self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            logger.exception('Error closing the connection of backend {}'.format(self.name))
+
+
 class BaseResponseManager(object):
 
     def process_response(self, email, entry):
@@ -50,3 +253,24 @@ class BaseResponseManager(object):
         @return boolean if the sending has been successful
         """
         raise NotImplementedError('process_response method not implemented')
+
+    def process_responses(self, emails, entries):
+        """
+        Returns a list telling for each email if it was successfully sent,
+        processing the response of every email against its entry. An
+        email whose response cannot be processed, because the backend
+        failed before handling it, is considered not sent.
+
+        @type emails: list of EmailMultiAlternatives
+        @type entries: list of EmailEntry, in the same order as emails
+        @return list of booleans
+        """
+        sent_list = []
+        for email, entry in zip(emails, entries):
+            try:
+                sent_list.append(self.process_response(email, entry))
+            except Exception:
+                logger.exception("Error processing the response of entry {}"\
+                                 .format(entry.id))
+                sent_list.append(False)
+        return sent_list
@@ -0,0 +1,243 @@
+"""
+Claiming of due entries, so several sender processes can run at the same
+time without sending an entry twice.
+
+A claimed entry moves to the `sending` status, with a lease owned by the
+claiming sender. Leases left behind by a crashed sender expire, and their
+entries go back to `pending`. Entries that fail are pending again only
+after a backoff delay, until they fail too often and are quarantined.
+"""
+import os
+import math
+import socket
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from emails.models import EmailKind, EmailEntry
+from emails.utils import bulk_update
+from custom.stats import increment
+
+
+send_logger = logging.getLogger('sender')
+
+
+def worker_id():
+    """Identifies the current sender process as the owner of its leases"""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def claim_entries(now_ts, limit=None, entry_ids=None):
+    """
+    Claims up to `limit` due entries for the current sender and returns
+    them, only among `entry_ids` if given. On postgres the candidate rows
+    are locked with `FOR UPDATE SKIP LOCKED`, so concurrent senders pick
+    different rows. Elsewhere the claim is an update conditioned on the
+    entry still being pending, and only the entries actually updated are
+    returned.
+
+    Every priority gets a share of the claim by its weight in
+    `SENDER_PRIORITY_WEIGHTS`, and the share a priority leaves unused goes
+    to the others, the heaviest first. The claimed entries are returned in
+    priority order.
+
+    Only the ids of the candidates are read. The claimed entries are then
+    loaded whole, but for the rendered templates, which are empty unless
+    rendered on schedule.
+
+    @type now_ts: int timestamp in UTC
+    @type limit: int
+    @type entry_ids: list of int
+    """
+    limit = limit or settings.SENDER_BATCH_SIZE
+    owner = worker_id()
+    lease_expires_at = now_ts + settings.SENDER_LEASE_SECONDS
+    due = EmailEntry.objects.filter(status=EmailEntry.STATUS_PENDING)\
+                            .filter(due_at__lte=now_ts)\
+                            .filter(kind__active=True)
+    if entry_ids is not None:
+        due = due.filter(id__in=entry_ids)
+
+    with transaction.atomic():
+        ids = []
+        exhausted = set()
+        priorities = _priorities()
+        # Every priority first gets its share of the claim...
+        total_weight = sum(weight for _, weight in priorities) or 1
+        for priority, weight in priorities:
+            share = min(int(math.ceil(limit * weight / total_weight)), limit - len(ids))
+            priority_ids = _candidate_ids(due.filter(priority=priority), share)
+            if len(priority_ids) < share:
+                exhausted.add(priority)
+            ids += priority_ids
+        # ...and then the share left unused goes to the others, by priority
+        for priority, _ in priorities:
+            if len(ids) >= limit:
+                break
+            if priority not in exhausted:
+                ids += _candidate_ids(due.filter(priority=priority).exclude(id__in=ids),
+                                      limit - len(ids))
+        if not ids:
+            return []
+        EmailEntry.objects.filter(id__in=ids)\
+                          .filter(status=EmailEntry.STATUS_PENDING)\
+                          .update(status=EmailEntry.STATUS_SENDING,
+                                  lease_owner=owner,
+                                  lease_expires_at=lease_expires_at)
+
+    entries = EmailEntry.objects.filter(id__in=ids)\
+                                .filter(status=EmailEntry.STATUS_SENDING)\
+                                .filter(lease_owner=owner)\
+                                .filter(lease_expires_at=lease_expires_at)\
+                                .prefetch_related('attachments')\
+                                .order_by('due_at', 'id')
+    if not settings.RENDER_ON_SCHEDULE:
+        # Only filled in advance with RENDER_ON_SCHEDULE, and big
+        entries = entries.defer('rendered_template', 'rendered_plain_template')
+    entries = list(entries)
+    rank = {priority: i for i, (priority, _) in enumerate(priorities)}
+    entries.sort(key=lambda entry: rank.get(entry.priority, len(rank)))
+    _attach_kinds(entries)
+    return entries
+
+
+def release_entries(entries, now_ts):
+    """
+    Gives back the claimed entries that were not sent nor discarded, like
+    those their origin did not allow, so they are pending again in
+    `SENDER_RELEASE_DELAY_SECONDS`. Were they due right away, they would
+    be the oldest due entries, claimed first over and over, and enough of
+    them would hold back all the others. The entries still sending are
+    given back in memory too.
+
+    @type now_ts: int timestamp in UTC
+    """
+    due_at = now_ts + settings.SENDER_RELEASE_DELAY_SECONDS
+    for entry in entries:
+        if entry.status == EmailEntry.STATUS_SENDING:
+            entry.status = EmailEntry.STATUS_PENDING
+            entry.due_at = due_at
+    return EmailEntry.objects.filter(id__in=[entry.id for entry in entries])\
+                             .filter(status=EmailEntry.STATUS_SENDING)\
+                             .filter(lease_owner=worker_id())\
+                             .update(status=EmailEntry.STATUS_PENDING,
+                                     due_at=due_at,
+                                     lease_owner='',
+                                     lease_expires_at=None)
+
+
+def defer_entries(entries):
+    """
+    Gives back claimed entries to be sent at their new `due_at`, without
+    counting it as a failed attempt.
+    """
+    for entry in entries:
+        entry.status = EmailEntry.STATUS_PENDING
+        entry.lease_owner = ''
+        entry.lease_expires_at = None
+    bulk_update(entries, ['status', 'due_at', 'lease_owner', 'lease_expires_at'])
+
+
+def retry_later(entry, error, now_ts):
+    """
+    Records a failed attempt to send a claimed entry, and gives it back as
+    pending once its backoff delay has passed. After `SENDER_MAX_ATTEMPTS`
+    failures the entry is quarantined instead, and it is not tried again.
+
+    @type entry: EmailEntry
+    @type error: str describing why the attempt failed
+    @type now_ts: int timestamp in UTC
+    """
+    entry.attempts += 1
+    entry.last_error = error
+    entry.lease_owner = ''
+    entry.lease_expires_at = None
+    if entry.attempts >= settings.SENDER_MAX_ATTEMPTS:
+        entry.status = EmailEntry.STATUS_QUARANTINED
+        entry.next_attempt_at = None
+        increment(settings.METRIC['SEND_QUARANTINED'])
+        send_logger.warning('[sender] Quarantined after {n} attempts. Entry id: {id}'\
+                            .format(n=entry.attempts, id=entry.id))
+    else:
+        entry.status = EmailEntry.STATUS_PENDING
+        entry.next_attempt_at = now_ts + retry_delay(entry.attempts)
+        entry.due_at = entry.next_attempt_at
+        increment(settings.METRIC['SEND_RETRY'])
+    entry.save(update_fields=['attempts', 'last_error', 'lease_owner',
+                              'lease_expires_at', 'status', 'next_attempt_at',
+                              'due_at'])
+
+
+def retry_delay(attempts):
+    """Seconds to wait before trying again an entry that failed `attempts` times"""
+    delay = settings.SENDER_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1)
+    return min(delay, settings.SENDER_RETRY_BACKOFF_MAX_SECONDS)
+
+
+def reclaim_expired_leases(now_ts):
+    """
+    Puts back to pending the entries whose lease has expired, which means
+    the sender that claimed them died before finishing.
+    """
+    count = EmailEntry.objects.filter(status=EmailEntry.STATUS_SENDING)\
+                              .filter(lease_expires_at__lt=now_ts)\
+                              .update(status=EmailEntry.STATUS_PENDING,
+                                      lease_owner='',
+                                      lease_expires_at=None)
+    if count:
+        increment(settings.METRIC['SEND_RECLAIMED'], count)
+        send_logger.warning('[sender] Reclaimed expired leases: {}'.format(count))
+    return count
+
+
+def _priorities():
+    """
+    The priorities with their weights in `SENDER_PRIORITY_WEIGHTS`, the
+    heaviest first.
+    """
+    weights = settings.SENDER_PRIORITY_WEIGHTS
+    return sorted(((priority, weights.get(priority, 0))
+                   for priority, _ in EmailKind.PRIORITY_CHOICES),
+                  key=lambda item: -item[1])
+
+
+def _candidate_ids(due, limit):
+    """
+    Returns the ids of up to `limit` of the due entries, oldest first. On
+    postgres their rows are locked, skipping those other senders locked.
+    """
+    if limit <= 0:
+        return []
+    candidates = due.order_by('due_at', 'id').values_list('id', flat=True)[:limit]
+    if connection.vendor == 'postgresql':
+        return _lock_skipping_locked(candidates)
+    return list(candidates.iterator())
+
+
+def _attach_kinds(entries):
+    """
+    Loads once every kind of the entries, with their images and fragments,
+    and shares it among its entries. Sending a whole batch then takes a
+    fixed number of queries, and the templates of a kind are not read
+    again for every entry.
+    """
+    kinds = EmailKind.objects.prefetch_related('images', 'fragments__images')\
+                             .in_bulk({entry.kind_id for entry in entries})
+    for entry in entries:
+        entry.kind = kinds[entry.kind_id]
+
+
+def _lock_skipping_locked(candidates):
+    """
+    Runs the candidates query locking its rows and skipping those already
+    locked by other senders. This Django version cannot build the
+    `SKIP LOCKED` clause, so it is appended to the compiled query.
+    """
+    sql, params = candidates.query.sql_with_params()
+    sql += ' FOR UPDATE OF {} SKIP LOCKED'.format(
+        connection.ops.quote_name(EmailEntry._meta.db_table)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,101 @@
+"""
+Adaptive concurrency of the sender. With `SENDER_ADAPTIVE_CONCURRENCY` the
+number of groups of entries being sent at the same time follows the
+backends: it grows by one after a round of sends answered in time, and it
+is halved as soon as sends get slower than `SENDER_LATENCY_TARGET` seconds
+per email, or fail more than `SENDER_MAX_ERROR_RATE` of the time (AIMD).
+It never goes over `SENDER_CONCURRENCY`.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from custom.stats import gauge
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """
+    Returns the controller shared by all the sending threads, or None if
+    the concurrency is not adaptive. Raises ImproperlyConfigured if
+    `SENDER_CONCURRENCY_MIN` is below 1.
+    """
+    global _controller
+    if not settings.SENDER_ADAPTIVE_CONCURRENCY:
+        return None
+    if settings.SENDER_CONCURRENCY_MIN < 1:
+        # No send would ever fit within a limit of 0
+        raise ImproperlyConfigured('SENDER_CONCURRENCY_MIN must be at least 1')
+    with _controller_lock:
+        if _controller is None:
+            _controller = AIMDController(settings.SENDER_CONCURRENCY_MIN,
+                                         settings.SENDER_CONCURRENCY)
+        return _controller
+
+
+def record_send(latency, error_rate):
+    """
+    Reports a round trip to a backend to the controller, if any.
+    @type latency: float seconds per email sent
+    @type error_rate: float between 0 and 1
+    """
+    controller = get_controller()
+    if controller is not None:
+        failed = error_rate > settings.SENDER_MAX_ERROR_RATE
+        controller.record(failed or latency > settings.SENDER_LATENCY_TARGET)
+
+
+@receiver(setting_changed)
+def _reset_controller(setting, **kwargs):
+    global _controller
+    if setting.startswith('SENDER_'):
+        with _controller_lock:
+            _controller = None
+
+
+class AIMDController(object):
+    """
+    Limits the sends in flight with additive increase and multiplicative
+    decrease. The limit grows by 1 / limit on every send in time, that is
+    by one for every round of `limit` sends, and is halved on a slow or
+    failed one. It is never below 1, so sends always go on.
+    """
+
+    def __init__(self, minimum, maximum, decrease=0.5):
+        self.minimum = max(minimum, 1)
+        self.maximum = maximum
+        self.decrease = decrease
+        self.limit = float(self.minimum)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Waits until a send fits within the limit, and holds its place"""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def record(self, congested):
+        with self._condition:
+            if congested:
+                self.limit = max(float(self.minimum), self.limit * self.decrease)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            limit = int(self.limit)
+            self._condition.notify_all()
+        gauge(settings.METRIC['SEND_CONCURRENCY_LIMIT'], limit)
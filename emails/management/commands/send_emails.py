@@ -1,8 +1,18 @@
 import time
+import logging
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from emails.send import send_entries
+from emails.backends import close_backends
+from emails.concurrency import get_controller
+from emails.render import warm_up_templates
+from emails.wheel import TimingWheel
+from emails.utils import now_timestamp
+from emailqueue.send_queue import SendQueueListener
+
+
+logger = logging.getLogger('emails')
 
 
 class Command(BaseCommand):
@@ -10,6 +20,78 @@ class Command(BaseCommand):
     help = 'Processes the email entries, sending them if proceed'
 
     def handle(self, *args, **options):
+        # Fails now on wrong adaptive concurrency settings, not once sending
+        get_controller()
+        if settings.RENDER_WARM_UP:
+            logger.info('Templates compiled: {}'.format(warm_up_templates()))
+        try:
+            if settings.SENDER_PUSH_ENABLED:
+                self.listen()
+            else:
+                self.poll()
+        finally:
+            close_backends()
+
+    def poll(self):
         while True:
             send_entries()
             time.sleep(settings.SENDER_ELLAPSED_SECONDS)
+
+    def listen(self):
+        """
+        Sends the entries as they are announced through the send queue, and
+        the entries due soon at their exact second from a timing wheel. The
+        database is swept every `SENDER_SWEEP_SECONDS` for the rest, and
+        the wheel refilled. A sweep claims batch after batch while they come
+        back full, so a backlog of entries nobody announced, like retried or
+        deferred ones, is not sent a batch per sweep. If the queue is
+        unreachable it polls until it can connect again.
+        """
+        wheel = TimingWheel()
+        listener = None
+        pending = 0
+        next_sweep = 0
+        while True:
+            now_ts = now_timestamp()
+            if now_ts >= next_sweep:
+                pending = max(pending, 1)
+                next_sweep = now_ts + settings.SENDER_SWEEP_SECONDS
+                wheel.refill(now_ts)
+
+            # Every claim takes up to SENDER_BATCH_SIZE of the due entries,
+            # announced or not, so a full one may have left some behind
+            while pending > 0:
+                claimed = self.send(wheel)
+                pending = 1 if len(claimed) >= settings.SENDER_BATCH_SIZE else 0
+            due_ids = wheel.pop_due(now_ts)
+            for i in range(0, len(due_ids), settings.SENDER_BATCH_SIZE):
+                self.send(wheel, entry_ids=due_ids[i:i + settings.SENDER_BATCH_SIZE])
+
+            timeout = self.seconds_until(next_sweep, wheel.next_due_at())
+            try:
+                if listener is None:
+                    listener = SendQueueListener(wheel)
+                pending = listener.wait(timeout)
+            except Exception:
+                logger.exception('Error waiting on the send queue')
+                if listener is not None:
+                    listener.close()
+                    listener = None
+                time.sleep(settings.SENDER_ELLAPSED_SECONDS)
+                pending = 1
+
+    def send(self, wheel, entry_ids=None):
+        """
+        Sends a batch of the due entries, only among `entry_ids` if given,
+        and returns the claimed entries. Those given back to be due again
+        within the window of the wheel are added to it.
+        """
+        claimed = []
+        send_entries(entry_ids=entry_ids, claimed=claimed)
+        wheel.reschedule(claimed)
+        return claimed
+
+    def seconds_until(self, *timestamps):
+        """Seconds until the start of the second of the earliest timestamp"""
+        next_ts = min(ts for ts in timestamps if ts is not None)
+        return max(next_ts - now_timestamp() - time.time() % 1, 0)
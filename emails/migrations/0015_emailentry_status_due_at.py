@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def forwards_status(apps, schema_editor):
+    """
+    Fills `status` and `due_at` from the legacy flags. The later updates
+    win, so an entry marked for deletion ends up as deleted whatever
+    else it is.
+    """
+    EmailEntry = apps.get_model('emails', 'EmailEntry')
+    EmailEntry.objects.filter(send_at__isnull=False).update(due_at=F('send_at'))
+    EmailEntry.objects.filter(sent=True).update(status='sent')
+    EmailEntry.objects.exclude(thirdparty_reject='').update(status='rejected')
+    EmailEntry.objects.filter(is_spam=True).update(status='spam')
+    EmailEntry.objects.filter(deleted=True).update(status='deleted')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0014_emailentry_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailentry',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('rejected', 'Rejected'), ('spam', 'Spam'), ('deleted', 'Deleted')], default='pending', max_length=12, verbose_name='delivery status'),
+        ),
+        migrations.AddField(
+            model_name='emailentry',
+            name='due_at',
+            field=models.IntegerField(default=0, verbose_name='due at (timestamp, UTC)'),
+        ),
+        migrations.RunPython(forwards_status, migrations.RunPython.noop),
+        # Both postgres and sqlite support partial indexes. Only the pending
+        # entries are indexed, so the index stays small however many entries
+        # have already been sent.
+        migrations.RunSQL(
+            ["CREATE INDEX emails_emailentry_pending_due_at "
+             "ON emails_emailentry (due_at) WHERE status = 'pending'"],
+            ["DROP INDEX emails_emailentry_pending_due_at"],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0015_emailentry_status_due_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailentry',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=100, verbose_name='claimed by sender'),
+        ),
+        migrations.AddField(
+            model_name='emailentry',
+            name='lease_expires_at',
+            field=models.IntegerField(null=True, verbose_name='claim expires at (timestamp, UTC)'),
+        ),
+        # Only the entries being sent hold a lease, so this index stays tiny
+        # and makes finding the leases of crashed senders cheap.
+        migrations.RunSQL(
+            ["CREATE INDEX emails_emailentry_sending_lease_expires_at "
+             "ON emails_emailentry (lease_expires_at) WHERE status = 'sending'"],
+            ["DROP INDEX emails_emailentry_sending_lease_expires_at"],
+        ),
+    ]
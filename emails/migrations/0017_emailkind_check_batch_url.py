@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0016_emailentry_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailkind',
+            name='check_batch_url',
+            field=models.URLField(blank=True, help_text='if set, the entries of this kind are checked in batches with a POST to this url, instead of one GET to the check url of every entry', verbose_name='batch check url'),
+        ),
+    ]
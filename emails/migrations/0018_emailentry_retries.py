@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0017_emailkind_check_batch_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailentry',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='failed attempts'),
+        ),
+        migrations.AddField(
+            model_name='emailentry',
+            name='last_error',
+            field=models.TextField(blank=True, verbose_name='last error'),
+        ),
+        migrations.AddField(
+            model_name='emailentry',
+            name='next_attempt_at',
+            field=models.IntegerField(null=True, verbose_name='next attempt at (timestamp, UTC)'),
+        ),
+        migrations.AlterField(
+            model_name='emailentry',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('rejected', 'Rejected'), ('spam', 'Spam'), ('deleted', 'Deleted'), ('quarantined', 'Quarantined')], default='pending', max_length=12, verbose_name='delivery status'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0018_emailentry_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailkind',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='emailentry',
+            name='rendered_kind_version',
+            field=models.PositiveIntegerField(null=True, verbose_name='rendered with kind version'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0019_kind_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailkind',
+            name='priority',
+            field=models.CharField(choices=[('transactional', 'Transactional'), ('normal', 'Normal'), ('bulk', 'Bulk')], default='normal', help_text='the sender shares its capacity among priorities by the weights in SENDER_PRIORITY_WEIGHTS', max_length=15, verbose_name='priority'),
+        ),
+        migrations.AddField(
+            model_name='emailentry',
+            name='priority',
+            field=models.CharField(choices=[('transactional', 'Transactional'), ('normal', 'Normal'), ('bulk', 'Bulk')], default='normal', max_length=15, verbose_name='priority'),
+        ),
+        # Every priority is claimed on its own, in due order
+        migrations.RunSQL(
+            ["CREATE INDEX emails_emailentry_pending_priority_due_at "
+             "ON emails_emailentry (priority, due_at) WHERE status = 'pending'"],
+            ["DROP INDEX emails_emailentry_pending_priority_due_at"],
+        ),
+    ]
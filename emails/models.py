@@ -3,6 +3,8 @@ import logging
 import base64
 import datetime
 from django.db import models, transaction
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from jsonfield import JSONField
@@ -12,6 +14,7 @@ from jsonfield import JSONField
 # So we need a custom assert function to check params.
 
 from emails.utils import custom_assert as cassert, EmailAssertionError
+from emails.utils import now_timestamp
 
 
 logger = logging.getLogger('emails')
@@ -21,9 +24,21 @@ class EmailKind(models.Model):
     """
     This model represents a kind of email. Created and configured manually
     through the admin panel.
+
+    Its `version` goes up on every change of the kind, its fragments or
+    their images, so entries rendered in advance know when they are stale.
     """
     MIN_NAME_LENGTH = 6
 
+    PRIORITY_TRANSACTIONAL = 'transactional'
+    PRIORITY_NORMAL = 'normal'
+    PRIORITY_BULK = 'bulk'
+    PRIORITY_CHOICES = (
+        (PRIORITY_TRANSACTIONAL, 'Transactional'),
+        (PRIORITY_NORMAL, 'Normal'),
+        (PRIORITY_BULK, 'Bulk'),
+    )
+
     name = models.CharField(max_length=255, verbose_name='email kind name')
     language = models.CharField(max_length=2, choices=settings.LANGUAGES,
                                 default=settings.DEFAULT_LANGUAGE_CODE,
@@ -52,11 +67,27 @@ class EmailKind(models.Model):
         verbose_name='default reply to (comma separated, can be named format)'
     )
     active = models.BooleanField(default=True, verbose_name='Is active')
+    priority = models.CharField(
+        max_length=15,
+        choices=PRIORITY_CHOICES,
+        default=PRIORITY_NORMAL,
+        verbose_name='priority',
+        help_text=('the sender shares its capacity among priorities by the '
+                   'weights in SENDER_PRIORITY_WEIGHTS')
+    )
+    check_batch_url = models.URLField(
+        blank=True,
+        verbose_name='batch check url',
+        help_text=('if set, the entries of this kind are checked in batches '
+                   'with a POST to this url, instead of one GET to the check '
+                   'url of every entry')
+    )
     fragments = models.ManyToManyField(
         'EmailKindFragment',
         related_name='kinds',
         blank=True
     )
+    version = models.PositiveIntegerField(default=1, editable=False)
 
     model_name = 'EmailKind'
 
@@ -67,6 +98,19 @@ class EmailKind(models.Model):
     def __str__(self):
         return '{}/{}'.format(self.name, self.language)
 
+    def save(self, *args, **kwargs):
+        changed = self.pk is not None
+        if changed:
+            self.version = models.F('version') + 1
+        super().save(*args, **kwargs)
+        if changed:
+            self.refresh_from_db(fields=['version'])
+            # Entries waiting to be sent follow the priority of their kind
+            EmailEntry.objects.filter(kind=self)\
+                              .filter(status=EmailEntry.STATUS_PENDING)\
+                              .exclude(priority=self.priority)\
+                              .update(priority=self.priority)
+
     def iter_all_images(self):
         for img in self.images.all():
             yield img
@@ -114,22 +158,26 @@ class EmailKind(models.Model):
         subject = params.get('subject', None) or self.default_subject
         reply_to = ','.join(params.get('reply_to', [])) or \
                    self.default_reply_to
-
+        send_at = params.get('send_at', None)
 
         with transaction.atomic():
             entry = EmailEntry.objects.create(
                 kind=self,
+                priority=self.priority,
                 customer_id=params.get('customer_id', ''),
                 context=context,
                 sender=sender,
                 recipients=recipients,
                 subject=subject,
                 reply_to=reply_to,
-                send_at=params.get('send_at', None),
+                send_at=send_at,
+                due_at=send_at if send_at is not None else now_timestamp(),
                 check_url=params.get('check_url', ''),
                 backend=params.get('backend', ''),
                 metadata=params.get('meta_fields', {}),
             )
+            if settings.RENDER_ON_SCHEDULE:
+                entry.prerender()
 
             attachs = params.get('attachs', [])
             for attach in attachs:
@@ -221,6 +269,14 @@ class EmailKindFragment(models.Model):
     def __str__(self):
         return '{} ({})'.format(self.name, 'plain' if self.is_plain else 'html')
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_kinds_version(self.kinds.all())
+
+    def delete(self, *args, **kwargs):
+        bump_kinds_version(self.kinds.all())
+        super().delete(*args, **kwargs)
+
 
 class EmailEntry(models.Model):
     """
@@ -229,9 +285,64 @@ class EmailEntry(models.Model):
     (EmailKind)
 
     It contains the data that is actually sent to the email backend.
+
+    The sender only looks at `status` and `due_at` to pick the entries to
+    send, both covered by a partial index over the pending entries. The
+    boolean flags are kept in sync for the admin and the API.
+
+    An entry that fails to be sent is retried later, with a growing delay
+    between attempts, and quarantined once it has failed too many times.
     """
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_REJECTED = 'rejected'
+    STATUS_SPAM = 'spam'
+    STATUS_DELETED = 'deleted'
+    STATUS_QUARANTINED = 'quarantined'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_REJECTED, 'Rejected'),
+        (STATUS_SPAM, 'Spam'),
+        (STATUS_DELETED, 'Deleted'),
+        (STATUS_QUARANTINED, 'Quarantined'),
+    )
+    # Fields written once an entry is handed to its backend, by the sender
+    # or by the response manager of the backend, and those written only
+    # once it was sent. The rendered templates are deferred when claimed,
+    # so they are not read back for the entries not sent.
+    RESULT_FIELDS = ('status', 'thirdparty_id', 'thirdparty_reject', 'is_spam')
+    SENT_FIELDS = RESULT_FIELDS + ('sent', 'datetime_sent', 'rendered_template',
+                                   'rendered_plain_template')
+
     kind = models.ForeignKey('EmailKind')
     send_at = models.IntegerField(null=True)
+    # Copied from the kind, so the sender can pick entries by priority
+    # without joining their kinds
+    priority = models.CharField(max_length=15,
+                                choices=EmailKind.PRIORITY_CHOICES,
+                                default=EmailKind.PRIORITY_NORMAL,
+                                verbose_name='priority')
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES,
+                              default=STATUS_PENDING,
+                              verbose_name='delivery status')
+    due_at = models.IntegerField(default=0,
+                                 verbose_name='due at (timestamp, UTC)')
+    lease_owner = models.CharField(max_length=100, blank=True,
+                                   verbose_name='claimed by sender')
+    lease_expires_at = models.IntegerField(
+        null=True,
+        verbose_name='claim expires at (timestamp, UTC)'
+    )
+    attempts = models.PositiveIntegerField(default=0,
+                                           verbose_name='failed attempts')
+    last_error = models.TextField(blank=True, verbose_name='last error')
+    next_attempt_at = models.IntegerField(
+        null=True,
+        verbose_name='next attempt at (timestamp, UTC)'
+    )
     sent = models.BooleanField(default=False, db_index=True)
     customer_id = models.CharField(max_length=30, blank=True,
                                    verbose_name='customer id')
@@ -270,11 +381,39 @@ class EmailEntry(models.Model):
         blank=True, verbose_name='Email meta fields', default={}
     )
 
+    rendered_kind_version = models.PositiveIntegerField(
+        null=True,
+        verbose_name='rendered with kind version'
+    )
+
     model_name = 'EmailEntry'
 
     def __str__(self):
         return '{} - {}'.format(self.id, self.kind)
 
+    def prerender(self):
+        """
+        Renders the templates of the entry ahead of sending, so the sender
+        can reuse them while the kind does not change. If rendering fails
+        the entry is left to be rendered when sent.
+        """
+        from emails.render import render_html, render_plain
+        try:
+            rendered_template = render_html(self.kind, self.context)
+            rendered_plain_template = render_plain(self.kind, self.context)
+        except Exception:
+            logger.warning('Entry {} could not be rendered in advance'.format(self.id))
+            return
+        self.rendered_template = rendered_template
+        self.rendered_plain_template = rendered_plain_template
+        self.rendered_kind_version = self.kind.version
+        self.save(update_fields=['rendered_template', 'rendered_plain_template',
+                                 'rendered_kind_version'])
+
+    def is_prerendered(self):
+        """Tells if the rendered templates are up to date with the kind"""
+        return self.rendered_kind_version == self.kind.version
+
 
 def get_attachment_filename(self, filename):
     """
@@ -344,6 +483,14 @@ class EmbeddedImage(EmailImage):
     def folder(self):
         return '{}/{}'.format(self.kind.name, self.kind.language)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_kinds_version(EmailKind.objects.filter(id=self.kind_id))
+
+    def delete(self, *args, **kwargs):
+        bump_kinds_version(EmailKind.objects.filter(id=self.kind_id))
+        super().delete(*args, **kwargs)
+
 
 class FragmentEmbeddedImage(EmailImage):
     """
@@ -363,6 +510,31 @@ class FragmentEmbeddedImage(EmailImage):
     def folder(self):
         return 'fragments/{}'.format(self.fragment.name)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_kinds_version(EmailKind.objects.filter(fragments=self.fragment_id))
+
+    def delete(self, *args, **kwargs):
+        bump_kinds_version(EmailKind.objects.filter(fragments=self.fragment_id))
+        super().delete(*args, **kwargs)
+
+
+def bump_kinds_version(kinds):
+    """Marks as changed the kinds of the queryset, without saving them"""
+    kinds.update(version=models.F('version') + 1)
+
+
+@receiver(m2m_changed, sender=EmailKind.fragments.through)
+def _fragments_changed(instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # instance is a fragment
+        kinds = EmailKind.objects.filter(id__in=pk_set) if pk_set else instance.kinds.all()
+    else:
+        kinds = EmailKind.objects.filter(id=instance.id)
+    bump_kinds_version(kinds)
+
 
 def give_me_bytes(string):
     """We want bytes, and only bytes"""
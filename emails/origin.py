@@ -0,0 +1,354 @@
+"""
+Checks with the producers of the entries if they can still be sent. An
+entry with a `check_url` is only sent if a GET to it answers 200 and
+{"allowed": true}. If it answers {"delete": true} the entry is marked for
+deletion.
+
+Producers often share one check url among many entries, so answers are
+cached for a while to avoid asking them over and over. Producers can also
+opt in, through the `check_batch_url` of an EmailKind, to be asked about
+many entries of that kind with a single request.
+
+Hosts whose checks keep failing are left alone for a while by a circuit
+breaker, so an unavailable producer does not slow down all the sending.
+"""
+import json
+import time
+import hashlib
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import caches
+
+from emails.models import EmailEntry
+from emails.claim import defer_entries
+from emails.utils import now_timestamp
+from custom.stats import increment, gauge
+
+
+logger = logging.getLogger('emails')
+
+OriginAnswer = collections.namedtuple('OriginAnswer', ('allowed', 'delete', 'error'))
+ERROR = OriginAnswer(allowed=False, delete=False, error=True)
+# The answer while the origin is not asked because its host is failing.
+# The entry is not sent, but it is not logged as an error either.
+SKIPPED = OriginAnswer(allowed=False, delete=False, error=False)
+
+# A single session for all the checks, so connections to every producer
+# are kept alive and reused. Its pools block once they hold
+# `ORIGIN_CHECK_MAX_PER_HOST` connections, which caps the requests in
+# flight to any single host.
+session = requests.Session()
+_adapter = HTTPAdapter(pool_maxsize=settings.ORIGIN_CHECK_MAX_PER_HOST,
+                       pool_block=True)
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+
+
+def check_origins(entries):
+    """
+    Returns the entries allowed by their origin. All the checks are made
+    at the same time, by up to `ORIGIN_CHECK_CONCURRENCY` threads. A check
+    url shared by several entries is requested only once, and the entries
+    of kinds with a `check_batch_url` are checked in batches through it.
+    Entries skipped because the breaker of their host is open are deferred
+    until the breaker lets a check through again.
+    @type entries: list of EmailEntry
+    """
+    urls = collections.OrderedDict()
+    batches = collections.OrderedDict()
+    for entry in entries:
+        if entry.kind.check_batch_url:
+            batches.setdefault(entry.kind.check_batch_url, []).append(entry)
+        elif entry.check_url:
+            urls[entry.check_url] = None
+
+    size = settings.ORIGIN_CHECK_BATCH_SIZE
+    checks = [(ask_origin, (url,)) for url in urls]
+    for batch_url, batch_entries in batches.items():
+        for i in range(0, len(batch_entries), size):
+            checks.append((ask_origin_batch, (batch_url, batch_entries[i:i + size])))
+
+    workers = min(settings.ORIGIN_CHECK_CONCURRENCY, len(checks))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(check, *args) for check, args in checks]
+        results = [future.result() for future in futures]
+    else:
+        results = [check(*args) for check, args in checks]
+
+    answers = dict(zip(urls, results[:len(urls)]))
+    entry_answers = {}
+    for batch_answers in results[len(urls):]:
+        entry_answers.update(batch_answers)
+
+    breaker.export_gauges()
+
+    allowed = []
+    deleted = []
+    skipped = []
+    for entry in entries:
+        if entry.kind.check_batch_url:
+            answer = entry_answers[entry.id]
+            url = entry.kind.check_batch_url
+        elif entry.check_url:
+            answer = answers[entry.check_url]
+            url = entry.check_url
+        else:
+            allowed.append(entry)
+            continue
+        if _apply_answer(entry, answer, url):
+            allowed.append(entry)
+        if answer.delete:
+            deleted.append(entry.id)
+        if answer is SKIPPED:
+            skipped.append(entry)
+    if deleted:
+        EmailEntry.objects.filter(id__in=deleted)\
+                          .update(deleted=True, status=EmailEntry.STATUS_DELETED)
+    if skipped:
+        due_at = now_timestamp() + settings.ORIGIN_BREAKER_COOLDOWN
+        for entry in skipped:
+            entry.due_at = due_at
+        defer_entries(skipped)
+    return allowed
+
+
+def allowed_by_origin(entry):
+    """
+    Returns True if there is not url value or if there is, and a
+    GET request to it returns 200, {"allowed": true}
+
+    Will mark the entry for deletion if {"allowed": false, "delete": true}
+    """
+    if not entry.check_url:
+        return True
+    answer = ask_origin(entry.check_url)
+    allowed = _apply_answer(entry, answer, entry.check_url)
+    if answer.delete:
+        entry.save(update_fields=['deleted', 'status'])
+    return allowed
+
+
+def ask_origin(url):
+    """
+    Returns the answer of the producer to a check url as an OriginAnswer.
+    Answers are cached for the `ORIGIN_CHECK_CACHE_TTL` seconds of their
+    type, or for the `max-age` the producer sets in `Cache-Control`.
+    While the breaker of the url host is open the url is not requested,
+    and the answer is SKIPPED.
+    """
+    origin_cache = caches[settings.ORIGIN_CHECK_CACHE]
+    key = _cache_key(url)
+    cached = origin_cache.get(key)
+    if cached is not None:
+        increment(settings.METRIC['ORIGIN_CACHE_HIT'])
+        return OriginAnswer(*cached)
+
+    host = urlsplit(url).netloc
+    if not breaker.allow(host):
+        return SKIPPED
+
+    increment(settings.METRIC['ORIGIN_CACHE_MISS'])
+    answer, max_age = _request_origin(url)
+    breaker.record(host, failed=answer.error)
+    ttl = max_age if max_age is not None else _answer_ttl(answer)
+    if ttl > 0:
+        origin_cache.set(key, tuple(answer), ttl)
+    return answer
+
+
+def _request_origin(url):
+    """
+    Requests a check url. Returns the OriginAnswer and the max-age of the
+    response, if any. Network errors, timeouts and responses that are not
+    a JSON object are answered as errors.
+    """
+    try:
+        response = session.get(url, timeout=settings.ORIGIN_CHECK_TIMEOUT)
+    except requests.RequestException:
+        logger.warning('Could not check url: {url}'.format(url=url), exc_info=True)
+        return ERROR, None
+
+    max_age = _max_age(response.headers.get('Cache-Control', ''))
+    if response.status_code != 200:
+        return ERROR, max_age
+    try:
+        parsed_response = _parse_json_object(response)
+    except ValueError:
+        logger.warning('Not a JSON object checking url: {url}'.format(url=url),
+                       exc_info=True)
+        return ERROR, None
+    answer = OriginAnswer(allowed=bool(parsed_response.get('allowed', False)),
+                          delete=bool(parsed_response.get('delete', False)),
+                          error=False)
+    return answer, max_age
+
+
+def ask_origin_batch(batch_url, entries):
+    """
+    Asks the batch check url of a kind about many of its entries with a
+    single POST, and returns a dict with the OriginAnswer of every entry
+    by its id. The request body is:
+
+        {"entries": [{"id": 42, "customer_id": "3838383",
+                      "check_url": "..."}, ...]}
+
+    and the expected response:
+
+        {"entries": {"42": {"allowed": true, "delete": false}, ...}}
+
+    Entries missing from the response, or all of them if the request
+    fails, are answered as errors. While the breaker of the host is open
+    they are all SKIPPED.
+    """
+    host = urlsplit(batch_url).netloc
+    if not breaker.allow(host):
+        return {entry.id: SKIPPED for entry in entries}
+
+    payload = {'entries': [
+        {'id': entry.id, 'customer_id': entry.customer_id, 'check_url': entry.check_url}
+        for entry in entries
+    ]}
+    try:
+        response = session.post(batch_url, json=payload,
+                                timeout=settings.ORIGIN_CHECK_TIMEOUT)
+        if response.status_code != 200:
+            raise ValueError('status code {}'.format(response.status_code))
+        decisions = _parse_json_object(response)['entries']
+        if not isinstance(decisions, dict):
+            raise ValueError('entries is not an object')
+    except (requests.RequestException, ValueError, KeyError):
+        logger.warning('Could not check batch url: {url}'.format(url=batch_url),
+                       exc_info=True)
+        breaker.record(host, failed=True)
+        return {entry.id: ERROR for entry in entries}
+    breaker.record(host, failed=False)
+
+    answers = {}
+    for entry in entries:
+        decision = decisions.get(str(entry.id))
+        if not isinstance(decision, dict):
+            answers[entry.id] = ERROR
+        else:
+            answers[entry.id] = OriginAnswer(allowed=bool(decision.get('allowed', False)),
+                                             delete=bool(decision.get('delete', False)),
+                                             error=False)
+    return answers
+
+
+def _parse_json_object(response):
+    response.encoding = 'utf-8'
+    parsed = json.loads(response.text)
+    if not isinstance(parsed, dict):
+        raise ValueError('not a JSON object')
+    return parsed
+
+
+def _cache_key(url):
+    """Cache key of a check url, grouped by host and safe for memcached"""
+    return 'origin:{host}:{digest}'.format(
+        host=urlsplit(url).netloc,
+        digest=hashlib.sha1(url.encode('utf8')).hexdigest()
+    )
+
+
+def _answer_ttl(answer):
+    if answer.error:
+        return settings.ORIGIN_CHECK_CACHE_TTL['error']
+    if answer.allowed:
+        return settings.ORIGIN_CHECK_CACHE_TTL['allowed']
+    return settings.ORIGIN_CHECK_CACHE_TTL['denied']
+
+
+def _max_age(cache_control):
+    """
+    Returns the seconds a response can be cached according to its
+    Cache-Control header, 0 if it must not be cached, or None if the header
+    says nothing about it.
+    """
+    directives = [d.strip().lower() for d in cache_control.split(',')]
+    if 'no-cache' in directives or 'no-store' in directives:
+        return 0
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                return max(int(directive[len('max-age='):]), 0)
+            except ValueError:
+                return None
+    return None
+
+
+def _apply_answer(entry, answer, url):
+    """Applies the answer to the entry, which the caller must save"""
+    if answer.delete:
+        entry.deleted = True
+        entry.status = EmailEntry.STATUS_DELETED
+    if answer.error:
+        logger.warning('There was an error checking url: {url} for emailentry {ee} of kind {ek}'\
+            .format(url=url, ee=entry.id, ek=entry.kind))
+    return answer.allowed
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the failures of the check urls of every host. After
+    `ORIGIN_BREAKER_FAILURES` failures in a row the breaker of a host
+    opens, and its checks are skipped, without any request, for
+    `ORIGIN_BREAKER_COOLDOWN` seconds. Then a single check goes through:
+    if it succeeds the breaker closes, otherwise it stays open for another
+    cool-down.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._failures = collections.defaultdict(int)
+        self._opened_at = {}
+
+    def allow(self, host):
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                return True
+            now = time.time()
+            if now - opened_at < settings.ORIGIN_BREAKER_COOLDOWN:
+                return False
+            # Let this check through, and hold the others for another
+            # cool-down while it is in flight.
+            self._opened_at[host] = now
+            return True
+
+    def record(self, host, failed):
+        with self._lock:
+            if not failed:
+                self._failures.pop(host, None)
+                if self._opened_at.pop(host, None) is not None:
+                    logger.warning('Circuit breaker closed for host {}'.format(host))
+                return
+            self._failures[host] += 1
+            if self._failures[host] >= settings.ORIGIN_BREAKER_FAILURES:
+                if host not in self._opened_at:
+                    logger.warning('Circuit breaker opened for host {}'.format(host))
+                self._opened_at[host] = time.time()
+
+    def export_gauges(self):
+        """Sends the number of open breakers and the state of every host"""
+        with self._lock:
+            hosts = set(self._failures) | set(self._opened_at)
+            states = {host: int(host in self._opened_at) for host in hosts}
+        gauge(settings.METRIC['ORIGIN_BREAKER_OPEN'], sum(states.values()))
+        for host, opened in states.items():
+            gauge('{}.{}'.format(settings.METRIC['ORIGIN_BREAKER_HOST'],
+                                 host.replace('.', '_').replace(':', '_')), opened)
+
+
+breaker = CircuitBreaker()
@@ -1,25 +1,54 @@
+import os
+import re
+import stat
+import hashlib
 import logging
-from copy import deepcopy
+import tempfile
+import threading
+import collections
+import collections.abc
 from functools import partial
+from types import MappingProxyType
 
 from django.forms.models import model_to_dict
 from django.conf import settings
 from django.core.mail import make_msgid
+from django.core.signals import setting_changed
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 import htmlmin
-from jinja2 import Environment, Markup
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, Markup, Template, \
+    TemplateNotFound
 
 from custom import import_from_module
+from emails.models import EmailKind, EmailKindFragment
 
 
 logger = logging.getLogger('emails')
 
+# The Jinja environments, with autoescape for html and without for plain
+# text, by autoescape. Filters are registered once, when created.
+_environments = {}
+# Compiled templates, least recently used first, by the model and pk they
+# belong to, autoescape and the hash of their source.
+_templates = collections.OrderedDict()
+_templates_lock = threading.Lock()
+# The bytecode cache in `RENDER_BYTECODE_CACHE_DIR`, by directory
+_bytecode_caches = {}
+# The meta of every kind, with the version it was built for, by pk
+_metas = {}
+# The last version rendered of every kind, by pk. Its fragments loaded for
+# an older version are loaded again.
+_kind_versions = {}
+
 
 def render_html(torender, context, test=False, ignore_minify=False):
     """
     Renders the HTML template of an emailkind or fragment with the
-    overrides contained in context. The rendered html returned is
-    minified if `MINIFY_HTML` is set to True in settings.
+    overrides contained in context. The html returned is minified if
+    `MINIFY_HTML` is set to True in settings. The template is minified
+    once, when compiled, so the emails rendered with it are not.
 
     @type torender: EmailKind or EmailKindFragment
     @type context: dict
@@ -31,12 +60,13 @@ def render_html(torender, context, test=False, ignore_minify=False):
     try:
         fullcontext = _get_full_context(torender, context)
         if _should_include_fragments(torender):
-            fullcontext['fragments'] = _fragments_context(torender, fullcontext,
-                                                          test=test, for_plain=False)
-        template_string = _render(torender.template, fullcontext, Environment(autoescape=True))
-        html = _embed_images(template_string, torender.images.all(), test)
-        if (settings.MINIFY_HTML and not ignore_minify):
-            html = _minify_html(html)
+            fullcontext['fragments'] = FragmentsContext(torender, fullcontext, for_plain=False)
+        minify = settings.MINIFY_HTML and not ignore_minify
+        template_string = _render(torender, torender.template, fullcontext,
+                                  autoescape=True, minify=minify)
+        html = _embed_images(template_string, _html_images(torender), test)
+        if minify:
+            html = html.strip()
         return html
     except Exception as e:
         logger.exception(
@@ -55,9 +85,8 @@ def render_plain(torender, context):
     """
     fullcontext = _get_full_context(torender, context)
     if _should_include_fragments(torender):
-        fullcontext['fragments'] = _fragments_context(torender, fullcontext, for_plain=True)
-    return _render(torender.plain_template, fullcontext,
-                   Environment(autoescape=False))
+        fullcontext['fragments'] = FragmentsContext(torender, fullcontext, for_plain=True)
+    return _render(torender, torender.plain_template, fullcontext, autoescape=False)
 
 
 def _minify_html(html):
@@ -69,45 +98,346 @@ def _minify_html(html):
         remove_optional_attribute_quotes=False).strip()
 
 
+# Jinja tags, and the placeholders they are swapped for while minifying
+_JINJA_TAG = re.compile(r'{{.*?}}|{%.*?%}|{#.*?#}', re.DOTALL)
+_PLACEHOLDER = re.compile('\ue000(\\d+)\ue001')
+# A tag where an attribute name goes gets an empty value when minified
+_PLACEHOLDER_ATTRIBUTE = re.compile('(\ue000\\d+\ue001[^\\s=>]*)=""')
+
+
+def _minify_template(template_string):
+    """
+    Minifies the html of a template keeping its Jinja tags as they are.
+    The tags are swapped for placeholders while minifying. If any of them
+    is lost, like a tag within an html comment, the template is returned
+    as it is.
+    """
+    if '\ue000' in template_string:
+        return template_string
+    tags = []
+
+    def placeholder(match):
+        tags.append(match.group(0))
+        return '\ue000{}\ue001'.format(len(tags) - 1)
+
+    minified = _minify_html(_JINJA_TAG.sub(placeholder, template_string))
+    minified = _PLACEHOLDER_ATTRIBUTE.sub(r'\1', minified)
+    if sorted(int(i) for i in _PLACEHOLDER.findall(minified)) != list(range(len(tags))):
+        return template_string
+    return _PLACEHOLDER.sub(lambda match: tags[int(match.group(1))], minified)
+
+
 def _should_include_fragments(torender):
     return hasattr(torender, 'fragments')
 
 
-def _fragments_context(emailkind, context, test=False, for_plain=False):
+def _html_images(torender):
+    """The images of an emailkind or fragment, and those of the html fragments of a kind"""
+    images = list(torender.images.all())
+    if _should_include_fragments(torender):
+        for fragment in torender.fragments.all():
+            if not fragment.is_plain:
+                images += fragment.images.all()
+    return images
+
+
+class FragmentsContext(collections.abc.Mapping):
+    """
+    The fragments of an emailkind, html or plain, by name, for the
+    templates that use them as `{{ fragments.name }}`. A fragment is only
+    rendered when used, with the same compiled template and context as
+    `{% include "name" %}`: the context of the kind over the default
+    context of the fragment.
     """
-    Returns a dict containing all the rendered fragments for a given
-    email kind and its context. The dict keys will be the fragment name
-    and the value a jinja2 html-safe string containing the rendered fragment
-    content.
-    @type emailkind: EmailKind
 
-    @param context: the emailkind full context
-    @type context dict
+    def __init__(self, emailkind, context, for_plain=False):
+        self._environment = _environment(autoescape=not for_plain)
+        self._parent = _template_name(emailkind)
+        self._context = context
+        self._names = [fragment.name for fragment in emailkind.fragments.all()
+                       if fragment.is_plain == for_plain]
+        self._rendered = {}
 
-    @param test: tells if the rendering is for testing
-    @type test: bool
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        if name not in self._rendered:
+            template = self._environment.get_template(name, self._parent)
+            self._rendered[name] = Markup(template.render(self._context))
+        return self._rendered[name]
 
-    @param for_plain: tells if the context is for plain text rendering.
-    @type for_play: bool
-    """
-    render_fn = render_plain if for_plain else partial(render_html, test=test, ignore_minify=True)
-    return {fragment.name: Markup(render_fn(fragment, context))
-            for fragment in emailkind.fragments.filter(is_plain=for_plain)}
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
 
 
 def _get_full_context(emailkind, additional):
-    default = emailkind.default_context
-    fullcontext = deepcopy(default)
-    fullcontext['meta'] = model_to_dict(emailkind)
-    fullcontext.update(additional)
-    return fullcontext
+    """
+    Returns the context of an emailkind or fragment as layers, looked up in
+    order: the values set while rendering, like the fragments, the
+    additional context, the meta of the kind and its default context.
+    Nothing is copied, so templates must not change the values they are
+    given. The default contexts of the fragments of a kind are not part of
+    it, every fragment gets its own when rendered.
+    """
+    return collections.ChainMap({}, additional, {'meta': _meta(emailkind)},
+                                emailkind.default_context)
+
+
+def _meta(torender):
+    """
+    The fields of an emailkind or fragment as a read-only dict. The one of
+    a kind is built once per version.
+    """
+    if torender.pk is None or not hasattr(torender, 'version'):
+        return MappingProxyType(model_to_dict(torender))
+    cached = _metas.get(torender.pk)
+    if cached is None or cached[0] != torender.version:
+        cached = _metas[torender.pk] = (torender.version,
+                                        MappingProxyType(model_to_dict(torender)))
+    return cached[1]
+
+
+def _render(torender, template_string, fullcontext, autoescape, minify=False):
+    if _should_include_fragments(torender):
+        _kind_versions[torender.pk] = torender.version
+    return _compiled(torender, template_string, autoescape, minify).render(fullcontext)
+
+
+def _compiled(torender, template_string, autoescape, minify=False):
+    """
+    Returns the compiled template of an emailkind or fragment, compiling it
+    only if it is not among the last `RENDER_TEMPLATE_CACHE_SIZE` used.
+    With `minify` its html is minified before compiling it.
+    """
+    digest = hashlib.sha1(template_string.encode('utf8')).hexdigest()
+    key = (torender._meta.model_name, torender.pk, autoescape, minify, digest)
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is not None:
+            _templates.move_to_end(key)
+            return template
+
+    if minify:
+        template_string = _minify_template(template_string)
+    template = _compile(template_string, _template_name(torender), autoescape)
+    with _templates_lock:
+        _templates[key] = template
+        while len(_templates) > settings.RENDER_TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template
+
+
+def _compile(template_string, name, autoescape):
+    """
+    Compiles a template, reusing the bytecode other processes stored for
+    the same source in `RENDER_BYTECODE_CACHE_DIR`, if set. Jinja only
+    looks up its bytecode cache for templates from a loader, so it is done
+    here for templates compiled from a string. The name is compiled into
+    the template, so the fragments it includes are found.
+    """
+    env = _environment(autoescape)
+    bytecode_cache = _bytecode_cache()
+    code = None
+    if bytecode_cache is not None:
+        digest = hashlib.sha1(template_string.encode('utf8')).hexdigest()
+        key = '{}:{}:{}'.format('html' if autoescape else 'plain', name, digest)
+        try:
+            bucket = bytecode_cache.get_bucket(env, key, None, template_string)
+        except Exception:
+            logger.warning('Could not load the bytecode of template {}'.format(key),
+                           exc_info=True)
+        else:
+            if bucket.code is None:
+                bucket.code = env.compile(template_string, name)
+                try:
+                    bytecode_cache.set_bucket(bucket)
+                except OSError:
+                    logger.warning('Could not store the bytecode of template {}'.format(key),
+                                   exc_info=True)
+            code = bucket.code
+    if code is None:
+        code = env.compile(template_string, name)
+    return env.template_class.from_code(env, code, env.make_globals(None))
+
+
+def _template_name(torender):
+    return '{}:{}'.format(torender._meta.model_name, torender.pk)
+
+
+def _bytecode_cache():
+    directory = settings.RENDER_BYTECODE_CACHE_DIR
+    if not directory:
+        return None
+    if directory not in _bytecode_caches:
+        _bytecode_caches[directory] = _open_bytecode_cache(directory)
+    return _bytecode_caches[directory]
+
+
+def _open_bytecode_cache(directory):
+    """
+    Returns the bytecode cache in the directory, created only readable by
+    the current user. The bytecode found there is run, so a directory some
+    other user owns or can write to is not used, as Jinja does with its
+    own default directory.
+    """
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        status = os.lstat(directory)
+    except OSError:
+        logger.warning('Could not create the bytecode cache {}'.format(directory),
+                       exc_info=True)
+        return None
+    if (not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid()
+            or stat.S_IMODE(status.st_mode) & 0o077):
+        logger.warning('Not using the bytecode cache {}, it is not a directory only '
+                       'the current user can access'.format(directory))
+        return None
+    return AtomicBytecodeCache(directory)
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """
+    A FileSystemBytecodeCache whose files are written aside and then moved
+    in place, so processes sharing the directory never read half a file.
+    """
+
+    def dump_bytecode(self, bucket):
+        fd, temporary = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(temporary, self._get_cache_filename(bucket))
+        except Exception:
+            os.remove(temporary)
+            raise
+
+
+def warm_up_templates():
+    """
+    Compiles the templates of every active emailkind and its fragments, so
+    the first emails rendered by a process do not pay for it. Returns how
+    many templates were compiled. Broken templates are logged and skipped.
+    """
+    count = 0
+    for kind in EmailKind.objects.filter(active=True).prefetch_related('fragments'):
+        _kind_versions[kind.pk] = kind.version
+        compilations = [partial(_compiled, kind, kind.template, True, settings.MINIFY_HTML),
+                        partial(_compiled, kind, kind.plain_template, False)]
+        for fragment in kind.fragments.all():
+            compilations.append(partial(_environment(not fragment.is_plain).get_template,
+                                        fragment.name, _template_name(kind)))
+        for compile_template in compilations:
+            try:
+                compile_template()
+                count += 1
+            except Exception:
+                logger.exception('Error compiling a template of {}'.format(kind))
+    return count
+
+
+class FragmentLoader(BaseLoader):
+    """
+    Loads the fragments of an emailkind, html or plain, for its templates
+    to use them with `{% include "name" %}`, or their macros with
+    `{% import "name" as name %}`. Their names are relative to the
+    template of the kind, like `emailkind:42/name`. The default context of
+    a fragment is given as the globals of its template.
+    """
+
+    def __init__(self, is_plain):
+        self.is_plain = is_plain
+
+    def get_source(self, environment, template):
+        fragment = self._fragment(template)
+        source = fragment.content
+        if not self.is_plain and settings.MINIFY_HTML:
+            source = _minify_template(source)
+        # A change of the fragment bumps the version of the kind
+        pk = int(template.partition('/')[0].partition(':')[2])
+        version = _kind_versions.get(pk)
+        return source, None, lambda: _kind_versions.get(pk) == version
+
+    def load(self, environment, name, globals=None):
+        globals = dict(globals or {}, **self._fragment(name).default_context)
+        return super().load(environment, name, globals)
+
+    def _fragment(self, template):
+        parent, _, name = template.partition('/')
+        model_name, _, pk = parent.partition(':')
+        fragment = None
+        if model_name == 'emailkind' and pk.isdigit():
+            fragment = EmailKindFragment.objects.filter(kinds=pk, name=name,
+                                                        is_plain=self.is_plain).first()
+        if fragment is None:
+            raise TemplateNotFound(template)
+        return fragment
+
+
+class _Template(Template):
+
+    def new_context(self, vars=None, shared=False, locals=None):
+        # Never shared, so an included fragment looks up its globals, its
+        # default context, under the context of the kind
+        return super().new_context(vars, False, locals)
+
+
+class _Environment(Environment):
+    template_class = _Template
+
+    def join_path(self, template, parent):
+        # Fragments include the others relative to the kind too
+        if parent is not None and parent.startswith('emailkind:'):
+            return '{}/{}'.format(parent.split('/')[0], template)
+        return template
+
+
+def _environment(autoescape):
+    env = _environments.get(autoescape)
+    if env is None:
+        env = _Environment(autoescape=autoescape,
+                           loader=FragmentLoader(is_plain=not autoescape),
+                           bytecode_cache=_bytecode_cache())
+        for filt in settings.FILTERS:
+            env.filters[filt[0]] = import_from_module(filt[1])
+        _environments[autoescape] = env
+    return env
+
+
+def forget_templates(model_name=None, pk=None):
+    """
+    Drops the compiled templates of an emailkind or fragment, by the
+    `_meta.model_name` and pk, or all of them if none is given.
+    """
+    with _templates_lock:
+        if model_name is None:
+            _templates.clear()
+            return
+        for key in [key for key in _templates if key[:2] == (model_name, pk)]:
+            del _templates[key]
+
+
+@receiver(post_save, sender=EmailKind)
+@receiver(post_delete, sender=EmailKind)
+@receiver(post_save, sender=EmailKindFragment)
+@receiver(post_delete, sender=EmailKindFragment)
+def _forget_changed_templates(sender, instance, **kwargs):
+    forget_templates(sender._meta.model_name, instance.pk)
+    if sender is EmailKind:
+        _metas.pop(instance.pk, None)
+    for env in list(_environments.values()):
+        env.cache.clear()
 
 
-def _render(template_string, fullcontext, env):
-    for filt in settings.FILTERS:
-        env.filters[filt[0]] = import_from_module(filt[1])
-    template = env.from_string(template_string)
-    return template.render(fullcontext)
+@receiver(setting_changed)
+def _reset_environments(setting, **kwargs):
+    if setting in ('FILTERS', 'MINIFY_HTML', 'RENDER_TEMPLATE_CACHE_SIZE',
+                   'RENDER_BYTECODE_CACHE_DIR'):
+        _environments.clear()
+        _bytecode_caches.clear()
+        forget_templates()
 
 
 def _embed_images(template, images, test=False):
@@ -117,8 +447,10 @@ def _embed_images(template, images, test=False):
             replace_src = 'src="{}"'.format(image.image.url)
         else:
             if not len(image.content_id):
+                # Not a change of the image, so no save() bumping the kind
                 image.content_id = make_msgid(image.placeholder_name)
-                image.save()
+                type(image).objects.filter(pk=image.pk)\
+                                   .update(content_id=image.content_id)
             replace_src = 'src="cid:{}"'.format(image.content_id[1:-1])
         template = template.replace(src_attr, replace_src)
     return template
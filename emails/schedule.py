@@ -1,6 +1,9 @@
 import logging
 from django.conf import settings
+from django.db import transaction
 from emails.models import EmailKind
+from emails.utils import now_timestamp
+from emailqueue.send_queue import publish_send
 from custom.stats import increment
 
 sched_logger = logging.getLogger('scheduler')
@@ -29,4 +32,8 @@ def schedule(name, language, params):
             .format(name, language)
         )
     entry = emailkind.generate_entry(params)
+    window_end = now_timestamp() + settings.SENDER_WHEEL_WINDOW_SECONDS
+    if settings.SENDER_PUSH_ENABLED and entry.due_at <= window_end:
+        # Tell the senders once the entry can actually be read
+        transaction.on_commit(lambda: publish_send(entry.id, entry.due_at))
     return entry
@@ -1,8 +1,9 @@
-import time
-import json
+import math
+import queue
+import collections
 import logging
-import requests
-from django.utils import timezone
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
 from django.core.mail import EmailMultiAlternatives
 from email.mime.image import MIMEImage
 from django.conf import settings
@@ -10,100 +11,224 @@ from django.conf import settings
 from emails.models import EmailEntry
 from emails.security import is_spam
 from emails.render import render_html, render_plain
-from emails.backends import send_with_backend
+from emails.backends import send_with_backend, send_batch_with_backend
+from emails.claim import claim_entries, release_entries, reclaim_expired_leases, \
+    retry_later, defer_entries
+from emails.throttle import throttle_domains
+from emails.concurrency import get_controller
+from emails.origin import check_origins
+from emails.utils import now_timestamp
 from custom.stats import increment
 
 
 logger = logging.getLogger('emails')
 send_logger = logging.getLogger('sender')
 
-def send_entries():
+def send_entries(entry_ids=None, claimed=None):
     """
-    Takes all the not sent entries, and send them if they are ready.
+    Claims a batch of the pending entries that are due, only among
+    `entry_ids` if given, and send them if their origin allows it. The
+    entries that could not be sent are released for a later try. Returns
+    how many were sent.
+
+    The origins of the whole batch are checked at once before sending. The
+    allowed entries are handed to the backends in groups of
+    `SENDER_SEND_BATCH_SIZE`. With `SENDER_CONCURRENCY` greater than 1 the
+    groups are sent by that many threads, as sending is mostly waiting on
+    the network.
+
+    If `claimed` is a list, the claimed entries are added to it as they
+    were left: those given back for later are pending, with the time they
+    are due again.
+    @type claimed: list
+    """
+    now_ts = now_timestamp()
+    reclaim_expired_leases(now_ts)
+    entries = claim_entries(now_ts, entry_ids=entry_ids)
+    if claimed is not None:
+        claimed.extend(entries)
+    try:
+        allowed = check_origins(entries)
+        size = settings.SENDER_SEND_BATCH_SIZE
+        groups = [allowed[i:i + size] for i in range(0, len(allowed), size)]
+        if settings.SENDER_CONCURRENCY > 1 and len(groups) > 1:
+            sent_counts = _process_concurrently(groups, settings.SENDER_CONCURRENCY)
+        else:
+            sent_counts = [_process_group(group) for group in groups]
+    finally:
+        release_entries(entries, now_timestamp())
+    return sum(sent_counts)
+
+
+def _process_group(entries):
+    """
+    Sends the entries not considered spam. Returns how many were actually
+    sent. The entries that failed, and were not rejected, are retried
+    later, and those for recipient domains over their limits are deferred.
     """
-    now_ts = int(time.mktime(timezone.now().timetuple()))
-    entries = EmailEntry.objects.filter(sent=False)\
-                                .filter(is_spam=False)\
-                                .filter(thirdparty_reject='')\
-                                .filter(kind__active=True)
+    to_send = []
+    spam = []
+    for entry in entries:
+        try:
+            if is_spam(entry):
+                entry.is_spam = True
+                entry.status = EmailEntry.STATUS_SPAM
+                spam.append(entry)
+                increment(settings.METRIC['SEND_IS_SPAM'])
+                continue
+        except Exception as e:
+            log_send_error(entry)
+            retry_later(entry, _describe(e), now_timestamp())
+            continue
+        to_send.append(entry)
+    if spam:
+        EmailEntry.objects.filter(id__in=[entry.id for entry in spam])\
+                          .update(is_spam=True, status=EmailEntry.STATUS_SPAM)
+    if settings.SENDER_DOMAIN_LIMITS:
+        to_send = _throttle_domains(to_send)
+
     sent_count = 0
+    for entry, sent, error in send_batch(to_send):
+        if sent:
+            sent_count += 1
+            increment(settings.METRIC['SEND_OK'])
+            send_logger.info('[sender] Send OK. Entry id: {}'.format(entry.id))
+        else:
+            increment(settings.METRIC['SEND_FAIL'])
+            send_logger.info('[sender] Send FAIL. Entry id: {}'.format(entry.id))
+            if entry.status == EmailEntry.STATUS_SENDING:
+                retry_later(entry, error, now_timestamp())
+    return sent_count
+
+
+def _throttle_domains(entries):
+    """
+    Returns the entries whose recipient domains are within their limits.
+    The others are deferred until their domain has room again.
+    """
+    now_ts = now_timestamp()
+    allowed = []
+    deferred = []
     for entry in entries:
-        if can_send(entry, now_ts):
-            try:
-                if is_spam(entry):
-                    entry.is_spam = True
-                    entry.save()
-                    increment(settings.METRIC['SEND_IS_SPAM'])
-                    continue
-
-                if send(entry):
-                    sent_count += 1
-                    increment(settings.METRIC['SEND_OK'])
-                    send_logger.info('[sender] Send OK. Entry id: {}'.format(entry.id))
+        wait = throttle_domains(entry)
+        if wait:
+            entry.due_at = now_ts + int(math.ceil(wait))
+            deferred.append(entry)
+        else:
+            allowed.append(entry)
+    if deferred:
+        defer_entries(deferred)
+        increment(settings.METRIC['SEND_DEFERRED'], len(deferred))
+    return allowed
+
+
+def _process_concurrently(groups, concurrency):
+    """
+    Processes the groups of entries with a pool of `concurrency` threads.
+    Every thread takes groups from a shared queue until it is empty, and
+    closes its own database connection when done. With adaptive
+    concurrency, fewer groups may be sent at once, as its controller says.
+    """
+    to_process = queue.Queue()
+    for group in groups:
+        to_process.put(group)
+
+    controller = get_controller()
+
+    def worker():
+        results = []
+        try:
+            while True:
+                try:
+                    group = to_process.get_nowait()
+                except queue.Empty:
+                    return results
+                if controller is None:
+                    results.append(_process_group(group))
                 else:
-                    log_send_error(entry)
-            except Exception:
-                log_send_error(entry)
-    return sent_count
+                    with controller.slot():
+                        results.append(_process_group(group))
+        finally:
+            connection.close()
+
+    workers = min(concurrency, len(groups))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(worker) for _ in range(workers)]
+    return [sent_count for future in futures for sent_count in future.result()]
+
 
 def log_send_error(entry):
     increment(settings.METRIC['SEND_FAIL'])
     logger.exception("An entry could not be sent: {}".format(entry.id))
     send_logger.info('[sender] Send FAIL. Entry id: {}'.format(entry.id))
 
-def can_send(entry, now_ts):
-    return time_arrived(entry.send_at, now_ts) and allowed_by_origin(entry)
-
 
-def time_arrived(send_at, now_ts):
+def send(emailentry):
     """
-    Returns True if there is not send_at value or if there is, and has
-    passed.
-    @type send_at: int timestamp in utc
-    @type now: int timestamp in UTC
+    Sends the email entry through the configured email backend.
+    @type emailentry: EmailEntry
     """
-    if send_at is None:
-        return True
-
-    return send_at <= now_ts
+    email = build_email(emailentry)
+    sent = send_with_backend(email, emailentry)
+    if not sent:
+        return None
+    return email
 
 
-def allowed_by_origin(entry):
+def send_batch(entries):
+    """
+    Builds the emails of the entries and sends them with one
+    `send_messages` call per backend. Returns a list of (entry, sent, error)
+    triples, where sent tells if the backend accepted the email, and error
+    why it did not. Entries whose email could not be built are reported as
+    not sent.
+    @type entries: list of EmailEntry
     """
-    Returns True if there is not url value or if there is, and a
-    GET request to it returns 200, {"allowed": true}
+    results = []
+    by_backend = collections.OrderedDict()
+    for entry in entries:
+        try:
+            email = build_email(entry)
+        except Exception as e:
+            logger.exception("The email of an entry could not be built: {}".format(entry.id))
+            results.append((entry, False, _describe(e)))
+            continue
+        name = entry.backend or settings.CUSTOM_DEFAULT_EMAIL_BACKEND
+        by_backend.setdefault(name, ([], []))
+        by_backend[name][0].append(email)
+        by_backend[name][1].append(entry)
 
-    Will mark the entry for deletion if {"allowed": false, "delete": true}
+    for name, (emails, backend_entries) in by_backend.items():
+        error = 'Not accepted by backend {}'.format(name)
+        try:
+            sent_list = send_batch_with_backend(name, emails, backend_entries)
+        except Exception as e:
+            logger.exception("Entries could not be sent by backend {}: {}".format(
+                name, [entry.id for entry in backend_entries]))
+            sent_list = [False] * len(backend_entries)
+            error = _describe(e)
+        results.extend((entry, sent, '' if sent else error)
+                       for entry, sent in zip(backend_entries, sent_list))
+    return results
 
-    TODO: make this an EmailEntry method
-    """
-    if not entry.check_url:
-        return True
-
-    allowed = False
-    response = requests.get(entry.check_url)
-    response.enconding = 'utf-8'
-    parsed_response = json.loads(response.text)
-    if response.status_code == 200:
-        allowed = parsed_response.get('allowed', False)
-        delete = parsed_response.get('delete', False)
-        if delete:
-            entry.deleted = True
-            entry.save()
-    else:
-        logger.warning('There was an error checking url: {url} for emailentry {ee} of kind {ek}'\
-            .format(url=entry.url, ee=entry.id, ek=entry.kind))
 
-    return allowed
+def _describe(error):
+    return '{}: {}'.format(type(error).__name__, error)
 
 
-def send(emailentry):
+def build_email(emailentry):
     """
-    Sends the email entry through the configured email backend.
+    Renders the email entry and builds the message to hand to the email
+    backend, with its embedded images, attachments and metadata. The
+    templates rendered in advance are reused if the kind did not change.
     @type emailentry: EmailEntry
     """
-    plain_body = render_plain(emailentry.kind, emailentry.context)
-    rich_body = render_html(emailentry.kind, emailentry.context)
+    if emailentry.is_prerendered():
+        plain_body = emailentry.rendered_plain_template
+        rich_body = emailentry.rendered_template
+    else:
+        plain_body = render_plain(emailentry.kind, emailentry.context)
+        rich_body = render_html(emailentry.kind, emailentry.context)
 
     email = EmailMultiAlternatives(
         subject=emailentry.subject,
@@ -122,7 +247,10 @@ def send(emailentry):
     for img in emailentry.kind.iter_all_images():
         content_id = img.content_id[1:-1]
         if content_id in rich_body:
-            image = MIMEImage(img.image.read())
+            # The kind and its images are shared by the entries of a batch,
+            # and by its threads, so every email reads from its own file
+            with img.image.storage.open(img.image.name, 'rb') as image_file:
+                image = MIMEImage(image_file.read())
             image.add_header('Content-ID', content_id)
             email.attach(image)
 
@@ -144,7 +272,4 @@ def send(emailentry):
     if len(emailentry.metadata) > 0:
         email.metadata.update(emailentry.metadata)
 
-    sent = send_with_backend(email, emailentry)
-    if not sent:
-        return None
     return email
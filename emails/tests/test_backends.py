@@ -0,0 +1,182 @@
+from unittest import mock
+
+from django.test import TestCase
+from django.test import override_settings
+
+from emails.backends import get_backend, close_backends, send_batch_with_backend
+from emails.models import EmailKind, EmailEntry
+from emails.send import build_email
+from emails.claim import claim_entries
+from emails.utils import now_timestamp
+from emails.tests.utils import EmailBackendMockSuccess, ResponseManagerStub
+
+
+@override_settings(
+    CUSTOM_EMAIL_BACKENDS = (
+        ('mybackend',
+         'emails.tests.utils.EmailBackendMockSuccess',
+         'emails.tests.utils.ResponseManagerStub'
+        ),
+    ),
+    CUSTOM_DEFAULT_EMAIL_BACKEND = 'mybackend'
+)
+class BackendRegistryTest(TestCase):
+    def tearDown(self):
+        close_backends()
+
+    def test_backend_resolved(self):
+        backend = get_backend('mybackend')
+        self.assertEqual('mybackend', backend.name)
+        self.assertIsInstance(backend.acquire(), EmailBackendMockSuccess)
+        self.assertIsInstance(backend.response_manager, ResponseManagerStub)
+
+    def test_backend_resolved_once(self):
+        self.assertIs(get_backend('mybackend'), get_backend('mybackend'))
+
+    def test_connection_reused_once_released(self):
+        backend = get_backend('mybackend')
+        connection = backend.acquire()
+        self.assertIsNot(connection, backend.acquire())
+        backend.release(connection)
+        self.assertIs(connection, backend.acquire())
+
+    @override_settings(SENDER_CONNECTION_IDLE_SECONDS=60)
+    @mock.patch('emails.backends.time')
+    def test_connection_idle_too_long_closed(self, mock_time):
+        backend = get_backend('mybackend')
+        mock_time.time.return_value = 1000.0
+        connection = backend.acquire()
+        backend.release(connection)
+        mock_time.time.return_value = 1061.0
+        with mock.patch.object(connection, 'close') as close:
+            self.assertIsNot(connection, backend.acquire())
+            close.assert_called_once_with()
+
+    def test_connection_released_when_throttle_fails(self):
+        backend = get_backend('mybackend')
+        connection = backend.acquire()
+        backend.release(connection)
+        entry = EmailEntry(id=1)
+        with mock.patch.object(backend, 'throttle', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                send_batch_with_backend('mybackend', [mock.Mock()], [entry])
+        self.assertIs(connection, backend.acquire())
+
+    def test_broken_connection_closed(self):
+        backend = get_backend('mybackend')
+        connection = backend.acquire()
+        with mock.patch.object(connection, 'close') as close:
+            backend.release(connection, broken=True)
+            close.assert_called_once_with()
+        self.assertIsNot(connection, backend.acquire())
+
+    def test_connection_in_use_closed_with_backend(self):
+        backend = get_backend('mybackend')
+        idle = backend.acquire()
+        in_use = backend.acquire()
+        backend.release(idle)
+        with mock.patch.object(idle, 'close') as close_idle, \
+                mock.patch.object(in_use, 'close') as close_in_use:
+            backend.close()
+            close_idle.assert_called_once_with()
+            self.assertFalse(close_in_use.called)
+            backend.release(in_use)
+            close_in_use.assert_called_once_with()
+
+    def test_backend_unknown(self):
+        self.assertRaises(Exception, get_backend, 'notmybackend')
+
+    def test_backend_forgotten_on_settings_change(self):
+        backend = get_backend('mybackend')
+        with override_settings(CUSTOM_EMAIL_BACKENDS=(
+                ('mybackend',
+                 'emails.tests.utils.EmailBackendMockFailure',
+                 'emails.tests.utils.ResponseManagerStub'),)):
+            self.assertIsNot(backend, get_backend('mybackend'))
+
+
+@override_settings(
+    CUSTOM_EMAIL_BACKENDS = (
+        ('mybackend',
+         'emails.tests.utils.EmailBackendMockSuccess',
+         'emails.tests.utils.ResponseManagerStub'
+        ),
+        ('rejectbackend',
+         'emails.tests.utils.EmailBackendMockReject',
+         'emails.tests.utils.ResponseManagerRejectStub'
+        ),
+        ('plainbackend',
+         'emails.tests.utils.EmailBackendMockSuccess',
+         'emails.tests.utils.ResponseManagerPlainStub'
+        ),
+    ),
+    CUSTOM_DEFAULT_EMAIL_BACKEND = 'mybackend'
+)
+class SendBatchResultsTest(TestCase):
+    def setUp(self):
+        self.ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, {{ name }}!',
+            plain_template='Hello, world! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+
+    def tearDown(self):
+        close_backends()
+        EmailKind.objects.all().delete()
+        EmailEntry.objects.all().delete()
+
+    def test_results_written_with_one_update(self):
+        entries = [self.ekind.generate_entry({'context': {'name': name}})
+                   for name in ('Luisa', 'Pepe', 'Ana')]
+        emails = [build_email(entry) for entry in entries]
+
+        with self.assertNumQueries(1):
+            sent_list = send_batch_with_backend('mybackend', emails, entries)
+        self.assertEqual([True, True, True], sent_list)
+        for entry, name in zip(entries, ('Luisa', 'Pepe', 'Ana')):
+            entry = EmailEntry.objects.get(id=entry.id)
+            self.assertEqual(EmailEntry.STATUS_SENT, entry.status)
+            self.assertTrue(entry.sent)
+            self.assertIsNotNone(entry.datetime_sent)
+            self.assertEqual('348dj38dj28do5jd82', entry.thirdparty_id)
+            self.assertEqual('Hello, {}!'.format(name), entry.rendered_template)
+
+    def test_response_manager_without_process_responses(self):
+        entries = [self.ekind.generate_entry({'backend': 'plainbackend'})
+                   for _ in range(2)]
+        emails = [build_email(entry) for entry in entries]
+
+        self.assertEqual([True, True],
+                         send_batch_with_backend('plainbackend', emails, entries))
+        for entry in EmailEntry.objects.all():
+            self.assertEqual(EmailEntry.STATUS_SENT, entry.status)
+            self.assertEqual('348dj38dj28do5jd82', entry.thirdparty_id)
+
+    def test_rejected_written(self):
+        entries = [self.ekind.generate_entry({'backend': 'rejectbackend'})
+                   for _ in range(2)]
+        emails = [build_email(entry) for entry in entries]
+
+        with self.assertNumQueries(1):
+            send_batch_with_backend('rejectbackend', emails, entries)
+        for entry in EmailEntry.objects.all():
+            self.assertEqual(EmailEntry.STATUS_REJECTED, entry.status)
+            self.assertEqual('potato', entry.thirdparty_reject)
+            self.assertFalse(entry.sent)
+
+    def test_rejected_claimed_written_without_rendered_templates(self):
+        for _ in range(2):
+            self.ekind.generate_entry({'backend': 'rejectbackend'})
+        entries = claim_entries(now_timestamp())
+        emails = [build_email(entry) for entry in entries]
+
+        with self.assertNumQueries(1):
+            send_batch_with_backend('rejectbackend', emails, entries)
+        for entry in EmailEntry.objects.all():
+            self.assertEqual(EmailEntry.STATUS_REJECTED, entry.status)
+            self.assertEqual('', entry.rendered_template)
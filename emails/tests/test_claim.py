@@ -0,0 +1,256 @@
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from emails.models import EmailKind, EmailEntry, EmailKindFragment
+from emails.render import render_plain
+from emails.tests.utils import create_upload_image, get_jpg_content
+from emails.send import build_email
+from emails.claim import claim_entries, release_entries, reclaim_expired_leases, \
+    retry_later, retry_delay, defer_entries
+
+
+class ClaimEntriesTest(TestCase):
+    def setUp(self):
+        self.ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, world!',
+            plain_template='Hello, world! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+
+    def tearDown(self):
+        EmailKind.objects.all().delete()
+        EmailEntry.objects.all().delete()
+        EmailKindFragment.objects.all().delete()
+
+    def test_claim_due_entries_only(self):
+        due = self.ekind.generate_entry({'send_at': 1000})
+        self.ekind.generate_entry({'send_at': 3000})
+
+        claimed = claim_entries(2000)
+        self.assertEqual([due.id], [entry.id for entry in claimed])
+        self.assertEqual(EmailEntry.STATUS_SENDING, claimed[0].status)
+        self.assertEqual(2000 + 5 * 60, claimed[0].lease_expires_at)
+        self.assertNotEqual('', claimed[0].lease_owner)
+
+    def test_claimed_entries_not_claimed_again(self):
+        self.ekind.generate_entry({'send_at': 1000})
+
+        self.assertEqual(1, len(claim_entries(2000)))
+        self.assertEqual(0, len(claim_entries(2000)))
+
+    def test_claim_limit(self):
+        for send_at in (1000, 1001, 1002):
+            self.ekind.generate_entry({'send_at': send_at})
+
+        claimed = claim_entries(2000, limit=2)
+        self.assertEqual([1000, 1001], [entry.due_at for entry in claimed])
+
+    def test_claim_lost_to_other_sender(self):
+        entry = self.ekind.generate_entry({'send_at': 1000})
+
+        with mock.patch('emails.claim.worker_id', return_value='other:1'):
+            claim_entries(2000)
+        self.assertEqual(0, len(claim_entries(2000)))
+        self.assertEqual('other:1', EmailEntry.objects.get(id=entry.id).lease_owner)
+
+    def test_claimed_entries_come_with_related_data(self):
+        fragment = EmailKindFragment.objects.create(name='f1', content='Bye {{ name }}',
+                                                    is_plain=True)
+        fragment.images.create(placeholder_name='f1.1', image=create_upload_image())
+        self.ekind.fragments.add(fragment)
+        self.ekind.images.create(placeholder_name='ekind.1', image=create_upload_image())
+        for send_at in (1000, 1001, 1002):
+            self.ekind.generate_entry({'send_at': send_at, 'context': {'name': 'Luisa'}})
+
+        claimed = claim_entries(2000)
+        with self.assertNumQueries(0):
+            for entry in claimed:
+                self.assertEqual(2, len(list(entry.kind.iter_all_images())))
+                self.assertEqual([], list(entry.attachments.all()))
+                render_plain(entry.kind, entry.context)
+        self.assertIs(claimed[0].kind, claimed[1].kind)
+
+    def test_emails_of_claimed_entries_embed_shared_images(self):
+        self.ekind.template = '<img src="cid:logo">'
+        self.ekind.save()
+        self.ekind.images.create(placeholder_name='logo', image=create_upload_image())
+        for send_at in (1000, 1001, 1002):
+            self.ekind.generate_entry({'send_at': send_at})
+
+        claimed = claim_entries(2000)
+        self.assertEqual(3, len(claimed))
+        for entry in claimed:
+            email = build_email(entry)
+            self.assertEqual(get_jpg_content(), email.attachments[0].get_payload(decode=True))
+
+    def test_claimed_entries_defer_rendered_templates(self):
+        self.ekind.generate_entry({'send_at': 1000})
+
+        entry = claim_entries(2000)[0]
+        self.assertEqual({'rendered_template', 'rendered_plain_template'},
+                         entry.get_deferred_fields())
+
+    @override_settings(RENDER_ON_SCHEDULE=True)
+    def test_claimed_entries_rendered_on_schedule(self):
+        self.ekind.generate_entry({'send_at': 1000})
+
+        entry = claim_entries(2000)[0]
+        self.assertEqual(set(), entry.get_deferred_fields())
+        self.assertEqual('Hello, world!', entry.rendered_template)
+
+    def test_release_entries(self):
+        self.ekind.generate_entry({'send_at': 1000})
+
+        claimed = claim_entries(2000)
+        self.assertEqual(1, release_entries(claimed, 2000))
+        self.assertEqual((EmailEntry.STATUS_PENDING, 2060), (claimed[0].status, claimed[0].due_at))
+        entry = EmailEntry.objects.get(id=claimed[0].id)
+        self.assertEqual(EmailEntry.STATUS_PENDING, entry.status)
+        self.assertEqual(2060, entry.due_at)
+        self.assertEqual('', entry.lease_owner)
+        self.assertIsNone(entry.lease_expires_at)
+
+    def test_released_entries_claimed_after_others(self):
+        self.ekind.generate_entry({'send_at': 1000})
+        self.ekind.generate_entry({'send_at': 1001})
+        later = self.ekind.generate_entry({'send_at': 1002})
+
+        release_entries(claim_entries(2000, limit=2), 2000)
+        self.assertEqual([later.id], [entry.id for entry in claim_entries(2001, limit=2)])
+
+    def test_defer_entries(self):
+        self.ekind.generate_entry({'send_at': 1000})
+        self.ekind.generate_entry({'send_at': 1000})
+
+        claimed = claim_entries(2000)
+        claimed[0].due_at = 2010
+        claimed[1].due_at = 2020
+        defer_entries(claimed)
+        self.assertEqual([(EmailEntry.STATUS_PENDING, 2010, '', 0),
+                          (EmailEntry.STATUS_PENDING, 2020, '', 0)],
+                         list(EmailEntry.objects.order_by('due_at')
+                                                .values_list('status', 'due_at',
+                                                             'lease_owner', 'attempts')))
+
+    def test_reclaim_expired_leases(self):
+        self.ekind.generate_entry({'send_at': 1000})
+
+        with mock.patch('emails.claim.worker_id', return_value='crashed:1'):
+            claim_entries(2000)
+        self.assertEqual(0, reclaim_expired_leases(2000))
+        self.assertEqual(1, reclaim_expired_leases(2000 + 5 * 60 + 1))
+        self.assertEqual(1, len(claim_entries(2000 + 5 * 60 + 1)))
+
+
+@override_settings(SENDER_PRIORITY_WEIGHTS={'transactional': 3, 'normal': 1, 'bulk': 0})
+class ClaimPrioritiesTest(TestCase):
+    def setUp(self):
+        self.kinds = {}
+        for priority, _ in EmailKind.PRIORITY_CHOICES:
+            self.kinds[priority] = EmailKind.objects.create(
+                name='my-test-email-{}'.format(priority),
+                language='es',
+                template='Hello, world!',
+                plain_template='Hello, world! soy antiguo',
+                default_sender='trololo@qdqmedia.com',
+                default_recipients='cliente@gemilio.com',
+                default_subject='Email Test',
+                default_reply_to='atecli@qdqmedia.com',
+                priority=priority
+            )
+
+    def tearDown(self):
+        EmailKind.objects.all().delete()
+        EmailEntry.objects.all().delete()
+
+    def generate(self, priority, count):
+        for _ in range(count):
+            self.kinds[priority].generate_entry({'send_at': 1000})
+
+    def claimed_priorities(self, limit):
+        return [entry.priority for entry in claim_entries(2000, limit=limit)]
+
+    def test_shares_by_weight(self):
+        self.generate('bulk', 10)
+        self.generate('normal', 10)
+        self.generate('transactional', 10)
+
+        self.assertEqual(['transactional'] * 3 + ['normal'],
+                         self.claimed_priorities(4))
+
+    def test_unused_share_goes_to_others(self):
+        self.generate('bulk', 10)
+        self.generate('transactional', 1)
+
+        self.assertEqual(['transactional'] + ['bulk'] * 3,
+                         self.claimed_priorities(4))
+
+    def test_pending_entries_follow_kind_priority(self):
+        self.generate('bulk', 2)
+        kind = self.kinds['bulk']
+        kind.priority = EmailKind.PRIORITY_TRANSACTIONAL
+        kind.save()
+
+        self.assertEqual(['transactional'] * 2,
+                         list(EmailEntry.objects.values_list('priority', flat=True)))
+
+
+@override_settings(SENDER_RETRY_BACKOFF_SECONDS=60,
+                   SENDER_RETRY_BACKOFF_MAX_SECONDS=300,
+                   SENDER_MAX_ATTEMPTS=3)
+class RetryLaterTest(TestCase):
+    def setUp(self):
+        self.ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, world!',
+            plain_template='Hello, world! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+
+    def tearDown(self):
+        EmailKind.objects.all().delete()
+        EmailEntry.objects.all().delete()
+
+    def test_retry_delay_grows_up_to_max(self):
+        self.assertEqual([60, 120, 240, 300, 300],
+                         [retry_delay(attempts) for attempts in range(1, 6)])
+
+    def test_failed_entry_backs_off(self):
+        self.ekind.generate_entry({'send_at': 1000})
+        entry = claim_entries(2000)[0]
+
+        retry_later(entry, 'ValueError: potato', 2000)
+        entry = EmailEntry.objects.get(id=entry.id)
+        self.assertEqual(EmailEntry.STATUS_PENDING, entry.status)
+        self.assertEqual(1, entry.attempts)
+        self.assertEqual('ValueError: potato', entry.last_error)
+        self.assertEqual(2060, entry.next_attempt_at)
+        self.assertEqual(2060, entry.due_at)
+        self.assertEqual('', entry.lease_owner)
+
+        self.assertEqual([], claim_entries(2059))
+        self.assertEqual([entry.id], [e.id for e in claim_entries(2060)])
+
+    def test_entry_quarantined_after_max_attempts(self):
+        self.ekind.generate_entry({'send_at': 1000})
+        now_ts = 2000
+        for _ in range(3):
+            entry = claim_entries(now_ts)[0]
+            retry_later(entry, 'ValueError: potato', now_ts)
+            now_ts = EmailEntry.objects.get(id=entry.id).due_at
+
+        entry = EmailEntry.objects.get(id=entry.id)
+        self.assertEqual(EmailEntry.STATUS_QUARANTINED, entry.status)
+        self.assertEqual(3, entry.attempts)
+        self.assertIsNone(entry.next_attempt_at)
+        self.assertEqual([], claim_entries(now_ts + 10 ** 6))
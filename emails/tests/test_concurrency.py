@@ -0,0 +1,73 @@
+from unittest.mock import patch
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+
+from emails.concurrency import AIMDController, get_controller, record_send
+
+
+class AIMDControllerTest(TestCase):
+    def test_additive_increase(self):
+        controller = AIMDController(1, 4)
+        controller.record(False)
+        self.assertEqual(2, controller.limit)
+        for _ in range(3):
+            controller.record(False)
+        self.assertEqual(3, int(controller.limit))
+
+    def test_multiplicative_decrease(self):
+        controller = AIMDController(1, 8)
+        controller.limit = 8.0
+        controller.record(True)
+        self.assertEqual(4, controller.limit)
+        for _ in range(5):
+            controller.record(True)
+        self.assertEqual(1, controller.limit)
+
+    def test_never_below_one(self):
+        controller = AIMDController(0, 4)
+        self.assertEqual(1, controller.limit)
+        controller.record(True)
+        self.assertEqual(1, controller.limit)
+        with controller.slot():
+            self.assertEqual(1, controller.in_flight)
+
+    def test_never_over_maximum(self):
+        controller = AIMDController(1, 2)
+        for _ in range(10):
+            controller.record(False)
+        self.assertEqual(2, controller.limit)
+
+    def test_slot_counts_in_flight(self):
+        controller = AIMDController(1, 2)
+        with controller.slot():
+            self.assertEqual(1, controller.in_flight)
+        self.assertEqual(0, controller.in_flight)
+
+    @patch('emails.concurrency.gauge')
+    def test_limit_exported(self, mock_gauge):
+        AIMDController(1, 4).record(False)
+        mock_gauge.assert_called_once_with('send.concurrency.limit', 2)
+
+
+class RecordSendTest(TestCase):
+    def test_not_adaptive(self):
+        self.assertIsNone(get_controller())
+        record_send(10, 1)
+
+    @override_settings(SENDER_ADAPTIVE_CONCURRENCY=True, SENDER_CONCURRENCY=8,
+                       SENDER_LATENCY_TARGET=1.0, SENDER_MAX_ERROR_RATE=0.1)
+    def test_slow_or_failing_sends_decrease(self):
+        controller = get_controller()
+        controller.limit = 8.0
+        record_send(0.5, 0)
+        self.assertEqual(8, controller.limit)
+        record_send(2.0, 0)
+        self.assertEqual(4, controller.limit)
+        record_send(0.5, 0.5)
+        self.assertEqual(2, controller.limit)
+
+    @override_settings(SENDER_ADAPTIVE_CONCURRENCY=True, SENDER_CONCURRENCY_MIN=0)
+    def test_minimum_below_one_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_controller()
@@ -3,6 +3,8 @@ from unittest import TestCase, skip
 from unittest import mock
 from unittest.mock import Mock
 
+from django.test import override_settings
+
 from emails.models import EmailKind, EmailEntry, EmailKindFragment
 from emails.models import EmbeddedImage, FragmentEmbeddedImage, get_image_filename
 from emails.tests.utils import create_upload_image
@@ -300,6 +302,26 @@ class GenerateEntryTest(TestCase):
         self.assertFalse(eentry.sent)
         self.assertIsNone(eentry.send_at)
 
+    def test_entry_pending_and_due_at_send_at(self):
+        ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, world!',
+            plain_template='Hello, world! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+
+        eentry = ekind.generate_entry({'send_at': 1434029573})
+        self.assertEqual(EmailEntry.STATUS_PENDING, eentry.status)
+        self.assertEqual(1434029573, eentry.due_at)
+
+        eentry = ekind.generate_entry({})
+        self.assertEqual(EmailEntry.STATUS_PENDING, eentry.status)
+        self.assertTrue(eentry.due_at > 0)
+
     def test_entry_no_defaults_empty_recipients(self):
         ekind = EmailKind.objects.create(
             name='my-test-email',
@@ -335,6 +357,60 @@ class GenerateEntryTest(TestCase):
                          {'f1.1', 'f1.2', 'f2.1', 'f2.2', 'ekind.1', 'ekind.2'})
 
 
+class KindVersionTest(TestCase):
+
+    def setUp(self):
+        self.ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, {{ name }}!',
+            plain_template='Hello, {{ name }}! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+
+    def tearDown(self):
+        EmailKind.objects.all().delete()
+        EmailKindFragment.objects.all().delete()
+
+    def version(self):
+        return EmailKind.objects.get(id=self.ekind.id).version
+
+    def test_version_bumped_on_changes(self):
+        self.assertEqual(1, self.version())
+        self.ekind.save()
+        self.assertEqual(2, self.ekind.version)
+
+        fragment = EmailKindFragment.objects.create(name='f1')
+        self.ekind.fragments.add(fragment)
+        self.assertEqual(3, self.version())
+        fragment.save()
+        self.assertEqual(4, self.version())
+        fragment.images.create(placeholder_name='f1.1', image=create_upload_image())
+        self.assertEqual(5, self.version())
+        self.ekind.images.create(placeholder_name='ekind.1', image=create_upload_image())
+        self.assertEqual(6, self.version())
+
+    @override_settings(RENDER_ON_SCHEDULE=True)
+    def test_entry_rendered_on_schedule(self):
+        entry = self.ekind.generate_entry({'context': {'name': 'Luisa'}})
+        entry = EmailEntry.objects.get(id=entry.id)
+        self.assertEqual('Hello, Luisa!', entry.rendered_template)
+        self.assertEqual('Hello, Luisa! soy antiguo', entry.rendered_plain_template)
+        self.assertTrue(entry.is_prerendered())
+
+        self.ekind.save()
+        entry = EmailEntry.objects.get(id=entry.id)
+        self.assertFalse(entry.is_prerendered())
+
+    def test_entry_not_rendered_on_schedule_by_default(self):
+        entry = self.ekind.generate_entry({'context': {'name': 'Luisa'}})
+        self.assertEqual('', entry.rendered_template)
+        self.assertFalse(entry.is_prerendered())
+
+
 class EmailKindFragmentTestCase(TestCase):
 
     def test_template_property(self):
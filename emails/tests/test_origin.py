@@ -0,0 +1,230 @@
+import json
+from unittest.mock import patch, Mock
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from emails.models import EmailKind, EmailEntry
+from emails.origin import check_origins, allowed_by_origin, ask_origin, \
+    breaker, SKIPPED
+
+
+def response_stub(body, status_code=200, headers=None):
+    return Mock(status_code=status_code, text=json.dumps(body),
+                headers=headers or {})
+
+
+class CheckOriginsTest(TestCase):
+    def setUp(self):
+        self.ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, world!',
+            plain_template='Hello, world! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+
+    def tearDown(self):
+        EmailKind.objects.all().delete()
+        EmailEntry.objects.all().delete()
+        caches[settings.ORIGIN_CHECK_CACHE].clear()
+        breaker.reset()
+
+    @patch('emails.origin.session')
+    def test_check_origins_each_url_once(self, mock_session):
+        urls = {
+            'http://service.qdqmedia.com/cansend/1': {'allowed': True},
+            'http://service.qdqmedia.com/cansend/2': {'allowed': False},
+        }
+        mock_session.get.side_effect = lambda url, timeout: response_stub(urls[url])
+        no_check = self.ekind.generate_entry({})
+        allowed1 = self.ekind.generate_entry({'check_url': 'http://service.qdqmedia.com/cansend/1'})
+        allowed2 = self.ekind.generate_entry({'check_url': 'http://service.qdqmedia.com/cansend/1'})
+        self.ekind.generate_entry({'check_url': 'http://service.qdqmedia.com/cansend/2'})
+
+        allowed = check_origins(list(EmailEntry.objects.order_by('id')))
+        self.assertEqual([no_check.id, allowed1.id, allowed2.id],
+                         [entry.id for entry in allowed])
+        self.assertEqual(2, mock_session.get.call_count)
+
+    @patch('emails.origin.session')
+    def test_check_origins_delete(self, mock_session):
+        mock_session.get.return_value = response_stub({'allowed': False, 'delete': True})
+        entry = self.ekind.generate_entry({'check_url': 'http://service.qdqmedia.com/cansend/1'})
+
+        self.assertEqual([], check_origins([entry]))
+        entry = EmailEntry.objects.get(id=entry.id)
+        self.assertTrue(entry.deleted)
+        self.assertEqual(EmailEntry.STATUS_DELETED, entry.status)
+
+    @patch('emails.origin.session')
+    def test_allowed_by_origin_timeout(self, mock_session):
+        mock_session.get.side_effect = requests.Timeout()
+        entry = self.ekind.generate_entry({'check_url': 'http://service.qdqmedia.com/cansend/1'})
+
+        self.assertFalse(allowed_by_origin(entry))
+        self.assertEqual(5, mock_session.get.call_args[1]['timeout'])
+
+    @patch('emails.origin.session')
+    def test_check_origins_batch_url(self, mock_session):
+        self.ekind.check_batch_url = 'http://service.qdqmedia.com/cansend'
+        self.ekind.save()
+        allowed = self.ekind.generate_entry({'customer_id': '1'})
+        denied = self.ekind.generate_entry({'customer_id': '2'})
+        deleted = self.ekind.generate_entry({'customer_id': '3'})
+        missing = self.ekind.generate_entry({'customer_id': '4'})
+        mock_session.post.return_value = response_stub({'entries': {
+            str(allowed.id): {'allowed': True},
+            str(denied.id): {'allowed': False},
+            str(deleted.id): {'allowed': False, 'delete': True},
+        }})
+
+        entries = list(EmailEntry.objects.order_by('id'))
+        self.assertEqual([allowed.id], [entry.id for entry in check_origins(entries)])
+        self.assertEqual(1, mock_session.post.call_count)
+        self.assertFalse(mock_session.get.called)
+        payload = mock_session.post.call_args[1]['json']
+        self.assertEqual(['1', '2', '3', '4'],
+                         [item['customer_id'] for item in payload['entries']])
+        self.assertTrue(EmailEntry.objects.get(id=deleted.id).deleted)
+        self.assertFalse(EmailEntry.objects.get(id=missing.id).deleted)
+
+    @patch('emails.origin.now_timestamp', return_value=1000)
+    @patch('emails.origin.session')
+    def test_check_origins_skipped_deferred(self, mock_session, mock_now):
+        url = 'http://service.qdqmedia.com/cansend/{}'
+        for i in range(settings.ORIGIN_BREAKER_FAILURES):
+            breaker.record('service.qdqmedia.com', failed=True)
+        entry = self.ekind.generate_entry({'check_url': url.format(1)})
+        entry.status = EmailEntry.STATUS_SENDING
+        entry.save()
+
+        self.assertEqual([], check_origins([entry]))
+        self.assertFalse(mock_session.get.called)
+        entry = EmailEntry.objects.get(id=entry.id)
+        self.assertEqual(EmailEntry.STATUS_PENDING, entry.status)
+        self.assertEqual(1000 + settings.ORIGIN_BREAKER_COOLDOWN, entry.due_at)
+
+    @patch('emails.origin.session')
+    def test_check_origins_batch_url_failure(self, mock_session):
+        self.ekind.check_batch_url = 'http://service.qdqmedia.com/cansend'
+        self.ekind.save()
+        self.ekind.generate_entry({})
+        mock_session.post.return_value = response_stub({}, status_code=500)
+
+        self.assertEqual([], check_origins(list(EmailEntry.objects.all())))
+
+
+class AskOriginCacheTest(TestCase):
+    url = 'http://service.qdqmedia.com/cansend/1'
+
+    def tearDown(self):
+        caches[settings.ORIGIN_CHECK_CACHE].clear()
+        breaker.reset()
+
+    @patch('emails.origin.session')
+    def test_denied_answer_cached(self, mock_session):
+        mock_session.get.return_value = response_stub({'allowed': False})
+
+        self.assertFalse(ask_origin(self.url).allowed)
+        self.assertFalse(ask_origin(self.url).allowed)
+        self.assertEqual(1, mock_session.get.call_count)
+
+    @patch('emails.origin.session')
+    def test_error_answer_cached(self, mock_session):
+        mock_session.get.side_effect = requests.ConnectionError()
+
+        self.assertTrue(ask_origin(self.url).error)
+        self.assertTrue(ask_origin(self.url).error)
+        self.assertEqual(1, mock_session.get.call_count)
+
+    @patch('emails.origin.session')
+    def test_no_cache_answer_not_cached(self, mock_session):
+        mock_session.get.return_value = response_stub(
+            {'allowed': False}, headers={'Cache-Control': 'no-cache'})
+
+        ask_origin(self.url)
+        ask_origin(self.url)
+        self.assertEqual(2, mock_session.get.call_count)
+
+    @patch('emails.origin.caches')
+    @patch('emails.origin.session')
+    def test_max_age_overrides_ttl(self, mock_session, mock_caches):
+        mock_caches.__getitem__.return_value.get.return_value = None
+        mock_session.get.return_value = response_stub(
+            {'allowed': True}, headers={'Cache-Control': 'public, max-age=120'})
+
+        ask_origin(self.url)
+        mock_cache = mock_caches.__getitem__.return_value
+        self.assertEqual(120, mock_cache.set.call_args[0][2])
+
+
+@override_settings(ORIGIN_BREAKER_FAILURES=2, ORIGIN_BREAKER_COOLDOWN=60,
+                   ORIGIN_CHECK_CACHE_TTL={'allowed': 0, 'denied': 0, 'error': 0})
+class CircuitBreakerTest(TestCase):
+    url = 'http://service.qdqmedia.com/cansend/{}'
+
+    def tearDown(self):
+        caches[settings.ORIGIN_CHECK_CACHE].clear()
+        breaker.reset()
+
+    @patch('emails.origin.session')
+    def test_opens_after_failures(self, mock_session):
+        mock_session.get.side_effect = requests.Timeout()
+        self.assertTrue(ask_origin(self.url.format(1)).error)
+        self.assertTrue(ask_origin(self.url.format(2)).error)
+
+        self.assertEqual(SKIPPED, ask_origin(self.url.format(3)))
+        self.assertEqual(2, mock_session.get.call_count)
+
+    @patch('emails.origin.session')
+    def test_other_hosts_not_affected(self, mock_session):
+        mock_session.get.side_effect = requests.Timeout()
+        ask_origin(self.url.format(1))
+        ask_origin(self.url.format(2))
+
+        mock_session.get.side_effect = None
+        mock_session.get.return_value = response_stub({'allowed': True})
+        self.assertTrue(ask_origin('http://other.qdqmedia.com/cansend/1').allowed)
+
+    @patch('emails.origin.time')
+    @patch('emails.origin.session')
+    def test_half_open_probe(self, mock_session, mock_time):
+        mock_time.time.return_value = 1000
+        mock_session.get.side_effect = requests.Timeout()
+        ask_origin(self.url.format(1))
+        ask_origin(self.url.format(2))
+
+        mock_time.time.return_value = 1061
+        mock_session.get.side_effect = None
+        mock_session.get.return_value = response_stub({'allowed': True})
+        self.assertTrue(ask_origin(self.url.format(3)).allowed)
+        self.assertTrue(ask_origin(self.url.format(4)).allowed)
+        self.assertEqual(4, mock_session.get.call_count)
+
+    @patch('emails.origin.time')
+    @patch('emails.origin.session')
+    def test_failed_probe_keeps_open(self, mock_session, mock_time):
+        mock_time.time.return_value = 1000
+        mock_session.get.side_effect = requests.Timeout()
+        ask_origin(self.url.format(1))
+        ask_origin(self.url.format(2))
+
+        mock_time.time.return_value = 1061
+        self.assertTrue(ask_origin(self.url.format(3)).error)
+        self.assertEqual(SKIPPED, ask_origin(self.url.format(4)))
+        self.assertEqual(3, mock_session.get.call_count)
+
+    @patch('emails.origin.session')
+    def test_not_json_is_a_failure(self, mock_session):
+        response = response_stub({})
+        response.text = '<html>Bad gateway</html>'
+        mock_session.get.return_value = response
+        self.assertTrue(ask_origin(self.url.format(1)).error)
+        self.assertTrue(ask_origin(self.url.format(2)).error)
+        self.assertEqual(SKIPPED, ask_origin(self.url.format(3)))
@@ -1,10 +1,17 @@
+import os
 import re
+import stat
+import shutil
+import tempfile
 from unittest import TestCase, mock
 
+from django.forms.models import model_to_dict
 from django.test import override_settings
+from jinja2 import Environment, TemplateNotFound
 
 from emails.models import EmailKind, EmbeddedImage, EmailKindFragment
-from emails.render import render_html, render_plain, _minify_html
+from emails.render import render_html, render_plain, _minify_html, _minify_template, \
+    _compiled, forget_templates, warm_up_templates, _get_full_context
 from emails.tests.utils import create_upload_image
 
 
@@ -325,25 +332,112 @@ class RenderTest(TestCase):
         rendered_html = render_html(ekind, context)
         self.assertEqual('<div>The girl is no one</div>', rendered_html)
 
+    def test_render_included_fragments(self):
+        header = EmailKindFragment.objects.create(
+            name='header',
+            content='{% macro greet(who) %}<b>{{ who }}</b>{% endmacro %}',
+            is_plain=False
+        )
+        footer = EmailKindFragment.objects.create(
+            name='footer',
+            content='<div>{{ smiley }} {{ name }}</div>',
+            default_context={'smiley': '^_^'},
+            is_plain=False
+        )
+        signature = EmailKindFragment.objects.create(
+            name='signature',
+            content='-- {{ name }}',
+            is_plain=True
+        )
+        ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='{% import "header" as header %}<h1>{{ header.greet(name) }}</h1>'
+                     '{% include "footer" %}',
+            plain_template='Hola {{ name }} {% include "signature" %}',
+            default_context={'name': 'Manola'}
+        )
+        ekind.fragments.add(header, footer, signature)
+        self.assertEqual('<h1><b>Manola</b></h1><div>^_^ Manola</div>', render_html(ekind, {}))
+        self.assertEqual('Hola Manola -- Manola', render_plain(ekind, {}))
+
+    def test_render_fragments_with_their_own_defaults(self):
+        first = EmailKindFragment.objects.create(name='first', content='<p>{{ title }}</p>',
+                                                 default_context={'title': 'A'})
+        second = EmailKindFragment.objects.create(name='second', content='<p>{{ title }}</p>',
+                                                  default_context={'title': 'B'})
+        ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='{{ fragments.first }}{{ fragments.second }}{% include "first" %}'
+                     '<h1>{{ title }}</h1>',
+            plain_template='',
+        )
+        ekind.fragments.add(first, second)
+        self.assertEqual('<p>A</p><p>B</p><p>A</p><h1></h1>', render_html(ekind, {}))
+        self.assertEqual('<p>C</p><p>C</p><p>C</p><h1>C</h1>',
+                         render_html(ekind, {'title': 'C'}))
+
+    def test_render_only_used_fragments(self):
+        used = EmailKindFragment.objects.create(name='used', content='<p>used</p>')
+        unused = EmailKindFragment.objects.create(name='unused', content='{{ 1 / 0 }}')
+        ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='{{ fragments.used }}',
+            plain_template='',
+        )
+        ekind.fragments.add(used, unused)
+        self.assertEqual('<p>used</p>', render_html(ekind, {}))
+
+    def test_render_not_attached_fragment(self):
+        EmailKindFragment.objects.create(name='footer', content='<p>footer</p>')
+        ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='{% include "footer" %}',
+            plain_template='',
+        )
+        with self.assertRaises(TemplateNotFound):
+            render_html(ekind, {})
+
+    def test_render_changed_fragment(self):
+        footer = EmailKindFragment.objects.create(name='footer', content='<p>Bye</p>')
+        ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='{% include "footer" %}',
+            plain_template='',
+        )
+        ekind.fragments.add(footer)
+        ekind.refresh_from_db()
+        self.assertEqual('<p>Bye</p>', render_html(ekind, {}))
+        EmailKindFragment.objects.filter(pk=footer.pk).update(content='<p>Adios</p>')
+        # As changed by another process, which bumps the kind version
+        EmailKind.objects.filter(pk=ekind.pk).update(version=ekind.version + 1)
+        ekind.refresh_from_db()
+        self.assertEqual('<p>Adios</p>', render_html(ekind, {}))
+
     @override_settings(MINIFY_HTML=True)
     def test_render_active_html_minification(self):
         ekind = EmailKind.objects.create(
             name='my-test-email',
             language='es',
-            template='<h1>Hola, {{ first_name }}</h1>',
+            template='<h1>  Hola,\n  {{ first_name }}  </h1>  ',
             plain_template='Hola, {{ first_name }}',
         )
 
-        with mock.patch('emails.render._minify_html') as _minify_html:
+        with mock.patch('emails.render._minify_html', wraps=_minify_html) as minify_html:
             rendered = render_html(ekind, {'first_name': 'Luisa'})
-            _minify_html.assert_any_call(mock.ANY)
-            self.assertEqual(rendered, _minify_html.return_value)
-            _minify_html.reset()
+            self.assertEqual('<h1> Hola, Luisa </h1>', rendered)
+            render_html(ekind, {'first_name': 'Arya'})
+            # Only the template is minified, once
+            minify_html.assert_called_once_with(mock.ANY)
 
-        with mock.patch('emails.render._minify_html') as _minify_html:
+        with mock.patch('emails.render._minify_html') as minify_html:
             rendered = render_html(ekind, {'first_name': 'Luisa'}, ignore_minify=True)
-            self.assertFalse(_minify_html.called)
-            self.assertNotEqual(rendered, _minify_html.return_value)
+            self.assertFalse(minify_html.called)
+            self.assertEqual('<h1>  Hola,\n  Luisa  </h1>  ', rendered)
 
     @override_settings(MINIFY_HTML=False)
     def test_render_not_active_html_minification(self):
@@ -359,6 +453,148 @@ class RenderTest(TestCase):
             self.assertNotEqual(rendered, _minify_html.return_value)
 
 
+class FullContextTest(TestCase):
+
+    def setUp(self):
+        self.ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='{{ meta.name }} {{ first_name }} {{ smiley }}',
+            plain_template='',
+            default_context={'first_name': 'Luisa'}
+        )
+
+    def tearDown(self):
+        EmailKind.objects.all().delete()
+        EmailKindFragment.objects.all().delete()
+
+    def test_layers(self):
+        fragment = EmailKindFragment.objects.create(
+            name='footer', content='', default_context={'smiley': '^_^', 'first_name': 'Yo'}
+        )
+        self.ekind.fragments.add(fragment)
+        context = _get_full_context(self.ekind, {'meta': 'overridden'})
+        self.assertEqual('overridden', context['meta'])
+        self.assertEqual('Luisa', context['first_name'])
+        self.assertNotIn('smiley', context)
+
+    def test_nothing_copied(self):
+        additional = {'first_name': 'Matias'}
+        context = _get_full_context(self.ekind, additional)
+        context['fragments'] = {}
+        self.assertEqual({'first_name': 'Matias'}, additional)
+        self.assertEqual({'first_name': 'Luisa'}, self.ekind.default_context)
+        self.assertIs(self.ekind.default_context, context.maps[3])
+
+    def test_meta_built_once_per_version(self):
+        with mock.patch('emails.render.model_to_dict', wraps=model_to_dict) as to_dict:
+            self.assertEqual('my-test-email Luisa ',
+                             render_html(self.ekind, {}, ignore_minify=True))
+            render_html(self.ekind, {}, ignore_minify=True)
+            self.assertEqual(1, to_dict.call_count)
+            self.ekind.name = 'renamed'
+            self.ekind.save()
+            self.assertEqual('renamed Luisa ', render_html(self.ekind, {}, ignore_minify=True))
+            self.assertEqual(2, to_dict.call_count)
+
+
+class CompiledTemplateCacheTest(TestCase):
+
+    def setUp(self):
+        without_bytecode_cache = override_settings(RENDER_BYTECODE_CACHE_DIR=None)
+        without_bytecode_cache.enable()
+        self.addCleanup(without_bytecode_cache.disable)
+        self.ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='<h1>Hola, {{ first_name }}</h1>',
+            plain_template='Hola, {{ first_name }}',
+        )
+
+    def tearDown(self):
+        EmailKind.objects.all().delete()
+        forget_templates()
+
+    def test_compiled_once(self):
+        with mock.patch('emails.render.Environment.compile',
+                        autospec=True, side_effect=Environment.compile) as compile:
+            first = _compiled(self.ekind, self.ekind.template, True)
+            self.assertIs(first, _compiled(self.ekind, self.ekind.template, True))
+            self.assertIsNot(first, _compiled(self.ekind, self.ekind.plain_template, False))
+            self.assertEqual(2, compile.call_count)
+
+    def test_changed_template_rendered(self):
+        self.assertEqual('Hola, Luisa', render_plain(self.ekind, {'first_name': 'Luisa'}))
+        self.ekind.plain_template = 'Adios, {{ first_name }}'
+        self.ekind.save()
+        self.assertEqual('Adios, Luisa', render_plain(self.ekind, {'first_name': 'Luisa'}))
+
+    def test_forgotten_on_save(self):
+        first = _compiled(self.ekind, self.ekind.template, True)
+        self.ekind.save()
+        self.assertIsNot(first, _compiled(self.ekind, self.ekind.template, True))
+
+    @override_settings(RENDER_TEMPLATE_CACHE_SIZE=1)
+    def test_least_recently_used_dropped(self):
+        first = _compiled(self.ekind, self.ekind.template, True)
+        _compiled(self.ekind, self.ekind.plain_template, False)
+        self.assertIsNot(first, _compiled(self.ekind, self.ekind.template, True))
+
+
+class BytecodeCacheTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(RENDER_BYTECODE_CACHE_DIR=self.directory)
+        self.settings.enable()
+        self.ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='<h1>Hola, {{ first_name }}</h1>',
+            plain_template='Hola, {{ first_name }}',
+        )
+
+    def tearDown(self):
+        self.settings.disable()
+        EmailKind.objects.all().delete()
+        EmailKindFragment.objects.all().delete()
+        forget_templates()
+        shutil.rmtree(self.directory)
+
+    def test_bytecode_reused(self):
+        render_plain(self.ekind, {'first_name': 'Luisa'})
+        # As if it were another process
+        forget_templates()
+        with mock.patch('emails.render.Environment.compile', autospec=True) as compile:
+            self.assertEqual('Hola, Luisa', render_plain(self.ekind, {'first_name': 'Luisa'}))
+            self.assertFalse(compile.called)
+
+    def test_directory_open_to_others_not_used(self):
+        os.chmod(self.directory, 0o777)
+        with override_settings(RENDER_BYTECODE_CACHE_DIR=self.directory):
+            self.assertEqual('Hola, Luisa', render_plain(self.ekind, {'first_name': 'Luisa'}))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_directory_created_private(self):
+        directory = os.path.join(self.directory, 'templates')
+        with override_settings(RENDER_BYTECODE_CACHE_DIR=directory):
+            render_plain(self.ekind, {'first_name': 'Luisa'})
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(directory).st_mode))
+        self.assertNotEqual([], os.listdir(directory))
+
+    def test_warm_up(self):
+        self.ekind.fragments.add(EmailKindFragment.objects.create(name='footer', content='Bye'))
+        EmailKindFragment.objects.create(name='unused', content='Unused')
+        EmailKind.objects.create(name='inactive', language='es', active=False,
+                                 template='<p></p>', plain_template='')
+        self.assertEqual(3, warm_up_templates())
+
+    def test_warm_up_skips_broken_templates(self):
+        self.ekind.fragments.add(EmailKindFragment.objects.create(name='footer',
+                                                                  content='{% if %}'))
+        self.assertEqual(2, warm_up_templates())
+
+
 class MinifyHtmlTestCase(TestCase):
 
     def test_whitespace(self):
@@ -387,6 +623,25 @@ class MinifyHtmlTestCase(TestCase):
             minified,
             '<span>Hello</span> <span>Yo!</span>')
 
+    def test_template_tags_kept(self):
+        template = """
+        <div   class="{{ css_class }}"  {% if hidden %}hidden{% endif %}>
+            {% for item in items %}
+                <p>  {{ item|e }}  </p>
+            {% endfor %}
+            {# A comment #}
+            <td {{ attributes }}>x</td>
+        </div>"""
+        self.assertEqual(
+            _minify_template(template),
+            '<div class="{{ css_class }}" {% if hidden %}hidden{% endif %}> '
+            '{% for item in items %} <p> {{ item|e }} </p> {% endfor %} {# A comment #} '
+            '<td {{ attributes }}>x</td> </div>')
+
+    def test_template_tags_in_comments(self):
+        template = '<p>{{ name }}</p>   <!-- {% if debug %} -->'
+        self.assertEqual(_minify_template(template), template)
+
     def test_keep_tag_attributes(self):
         # We need to be extra-careful with tag attributes, see htmlmin issues: #32 and #33
         # <https://github.com/mankyd/htmlmin/issues>
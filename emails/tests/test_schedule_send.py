@@ -1,9 +1,11 @@
-from unittest.mock import patch
+from unittest.mock import patch, ANY
 import time
 import json
 import base64
 import datetime
 
+from django.conf import settings
+from django.core.cache import caches
 from django.test import override_settings
 from django.test import TestCase
 from django.utils import timezone
@@ -11,9 +13,12 @@ from django.utils import timezone
 from emails.models import EmailKind, EmbeddedImage, EmailEntry, \
     Attachment
 from emails.send import send, send_entries
+from emails.origin import breaker
 from emails.schedule import schedule
 from emails.clean import clean_entries
+from emails.management.commands.send_emails import Command as SendEmailsCommand
 from emails.tests.utils import create_upload_image, get_jpg_content
+from emails.tests.utils import EmailBackendMockSuccess
 from emails.utils import EmailAssertionError
 
 
@@ -57,6 +62,7 @@ class SendEntriesTest(TestCase):
         entry_params = {}
         entry = schedule('my-test-email', 'es', entry_params)
         entry.is_spam = True
+        entry.status = EmailEntry.STATUS_SPAM
         entry.save()
         send_entries()
 
@@ -64,12 +70,104 @@ class SendEntriesTest(TestCase):
         self.assertFalse(entry.sent)
         self.assertIsNone(entry.datetime_sent)
 
+    @override_settings(SENDER_CONCURRENCY=4, SENDER_SEND_BATCH_SIZE=1)
+    @patch('emails.send.release_entries')
+    @patch('emails.send.claim_entries')
+    @patch('emails.send.check_origins')
+    @patch('emails.send._process_group')
+    def test_send_entries_concurrently(self, mock_process, mock_check, mock_claim, mock_release):
+        entries = [EmailEntry(id=i) for i in range(10)]
+        mock_claim.return_value = entries
+        mock_check.side_effect = lambda entries: entries
+        mock_process.side_effect = lambda group: int(group[0].id % 2 == 0)
+
+        sent_count = send_entries()
+        self.assertEqual(5, sent_count)
+        self.assertEqual(
+            sorted(entry.id for entry in entries),
+            sorted(call[0][0][0].id for call in mock_process.call_args_list)
+        )
+        mock_release.assert_called_once_with(entries, ANY)
+
+
+@override_settings(SENDER_PUSH_ENABLED=True)
+class ScheduleSendQueueTest(TestCase):
+    def setUp(self):
+        EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, world!',
+            plain_template='Hello, world! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+
+    def tearDown(self):
+        EmailKind.objects.all().delete()
+        EmailEntry.objects.all().delete()
+
+    @patch('emails.schedule.publish_send')
+    @patch('emails.schedule.transaction.on_commit')
+    def test_due_entry_published_on_commit(self, mock_on_commit, mock_publish):
+        entry = schedule('my-test-email', 'es', {})
+        self.assertFalse(mock_publish.called)
+
+        mock_on_commit.call_args[0][0]()
+        mock_publish.assert_called_once_with(entry.id, entry.due_at)
+
+    @override_settings(SENDER_WHEEL_WINDOW_SECONDS=600)
+    @patch('emails.schedule.publish_send')
+    @patch('emails.schedule.transaction.on_commit')
+    def test_entry_due_within_wheel_window_published(self, mock_on_commit, mock_publish):
+        send_at = int(time.time()) + 300
+        entry = schedule('my-test-email', 'es', {'send_at': send_at})
+
+        mock_on_commit.call_args[0][0]()
+        mock_publish.assert_called_once_with(entry.id, send_at)
+
+    @override_settings(SENDER_WHEEL_WINDOW_SECONDS=600)
+    @patch('emails.schedule.transaction.on_commit')
+    def test_future_entry_not_published(self, mock_on_commit):
+        schedule('my-test-email', 'es', {'send_at': int(time.time()) + 3600})
+        self.assertFalse(mock_on_commit.called)
+
+    @override_settings(SENDER_PUSH_ENABLED=False)
+    @patch('emails.schedule.transaction.on_commit')
+    def test_not_published_without_push(self, mock_on_commit):
+        schedule('my-test-email', 'es', {})
+        self.assertFalse(mock_on_commit.called)
+
+
+@override_settings(SENDER_PUSH_ENABLED=True, SENDER_BATCH_SIZE=2)
+class SendEmailsListenTest(TestCase):
+
+    @patch('emails.management.commands.send_emails.SendQueueListener')
+    @patch('emails.management.commands.send_emails.send_entries')
+    def test_sweep_claims_while_full(self, mock_send_entries, mock_listener):
+        claims = [[EmailEntry(id=1), EmailEntry(id=2)],
+                  [EmailEntry(id=3), EmailEntry(id=4)],
+                  [EmailEntry(id=5)]]
+
+        def send_entries(entry_ids=None, claimed=None):
+            claimed.extend(claims.pop(0))
+        mock_send_entries.side_effect = send_entries
+        # Stops the command when it waits after the sweep
+        mock_listener.return_value.wait.side_effect = KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            SendEmailsCommand().listen()
+        self.assertEqual(3, mock_send_entries.call_count)
+
 
 class ScheduleAndSendIntegrationTest(TestCase):
 
     def tearDown(self):
         EmailKind.objects.all().delete()
         EmailEntry.objects.all().delete()
+        caches[settings.ORIGIN_CHECK_CACHE].clear()
+        breaker.reset()
 
     @override_settings(
         CUSTOM_EMAIL_BACKENDS = (
@@ -145,10 +243,10 @@ class ScheduleAndSendIntegrationTest(TestCase):
         sent_count = send_entries()
         self.assertEqual(1, sent_count)
 
-    @patch('emails.send.requests.models.Response')
-    @patch('emails.send.requests')
+    @patch('emails.origin.requests.models.Response')
+    @patch('emails.origin.session')
     def test_schedule_without_send_at_with_check_url_false_not_sent(
-            self, mock_requests, mock_Response
+            self, mock_session, mock_Response
     ):
         EmailKind.objects.create(
             name='my-test-email',
@@ -165,17 +263,17 @@ class ScheduleAndSendIntegrationTest(TestCase):
             'check_url': 'http://service.qdqmedia.com/cansend/34324/blah'
         })
 
-        mock_Response.configure_mock(status_code=200)
+        mock_Response.configure_mock(status_code=200, headers={})
         mock_Response.configure_mock(text=json.dumps({'allowed': False}))
-        mock_requests.get.return_value = mock_Response
+        mock_session.get.return_value = mock_Response
 
         sent_count = send_entries()
         self.assertEqual(0, sent_count)
 
-    @patch('emails.send.requests.models.Response')
-    @patch('emails.send.requests')
+    @patch('emails.origin.requests.models.Response')
+    @patch('emails.origin.session')
     def test_schedule_without_send_at_with_check_url_false_not_sent_delete(
-            self, mock_requests, mock_Response
+            self, mock_session, mock_Response
     ):
         EmailKind.objects.create(
             name='my-test-email',
@@ -192,9 +290,9 @@ class ScheduleAndSendIntegrationTest(TestCase):
             'check_url': 'http://service.qdqmedia.com/cansend/34324/blah'
         })
 
-        mock_Response.configure_mock(status_code=200)
+        mock_Response.configure_mock(status_code=200, headers={})
         mock_Response.configure_mock(text=json.dumps({'allowed': False, 'delete': True}))
-        mock_requests.get.return_value = mock_Response
+        mock_session.get.return_value = mock_Response
 
         sent_count = send_entries()
         self.assertEqual(0, sent_count)
@@ -214,10 +312,10 @@ class ScheduleAndSendIntegrationTest(TestCase):
         ),
         CUSTOM_DEFAULT_EMAIL_BACKEND = 'mybackend'
     )
-    @patch('emails.send.requests.models.Response')
-    @patch('emails.send.requests')
+    @patch('emails.origin.requests.models.Response')
+    @patch('emails.origin.session')
     def test_schedule_without_send_at_with_check_url_true_sent(
-            self, mock_requests, mock_Response
+            self, mock_session, mock_Response
     ):
         EmailKind.objects.create(
             name='my-test-email',
@@ -234,9 +332,9 @@ class ScheduleAndSendIntegrationTest(TestCase):
             'check_url': 'http://service.qdqmedia.com/cansend/34324/blah'
         })
 
-        mock_Response.configure_mock(status_code=200)
+        mock_Response.configure_mock(status_code=200, headers={})
         mock_Response.configure_mock(text=json.dumps({'allowed': True}))
-        mock_requests.get.return_value = mock_Response
+        mock_session.get.return_value = mock_Response
 
         sent_count = send_entries()
         self.assertEqual(1, sent_count)
@@ -267,6 +365,7 @@ class ScheduleAndSendIntegrationTest(TestCase):
 
         entry = EmailEntry.objects.get(id=entry.id)
         self.assertTrue(entry.sent)
+        self.assertEqual(EmailEntry.STATUS_SENT, entry.status)
         self.assertEqual('348dj38dj28do5jd82', entry.thirdparty_id)
         self.assertEqual('Hello, world!', entry.rendered_template)
         self.assertEqual('Hello, world! soy antiguo',
@@ -313,6 +412,38 @@ class ScheduleAndSendIntegrationTest(TestCase):
         self.assertEqual('', entry.rendered_plain_template)
         self.assertIsNone(entry.datetime_sent)
 
+    @override_settings(
+        CUSTOM_EMAIL_BACKENDS = (
+            ('mybackend',
+             'emails.tests.utils.EmailBackendMockFailure',
+             'emails.tests.utils.ResponseManagerStub'
+            ),
+        ),
+        CUSTOM_DEFAULT_EMAIL_BACKEND = 'mybackend'
+    )
+    def test_send_entries_failure_retried_later(self):
+        EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, world!',
+            plain_template='Hello, world! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+        entry = schedule('my-test-email', 'es', {})
+        self.assertEqual(0, send_entries())
+
+        entry = EmailEntry.objects.get(id=entry.id)
+        self.assertFalse(entry.sent)
+        self.assertEqual(EmailEntry.STATUS_PENDING, entry.status)
+        self.assertEqual(1, entry.attempts)
+        self.assertEqual('Not accepted by backend mybackend', entry.last_error)
+        self.assertGreater(entry.due_at, entry.send_at or 0)
+        self.assertEqual(0, send_entries())
+        self.assertEqual(1, EmailEntry.objects.get(id=entry.id).attempts)
+
     @override_settings(
         CUSTOM_EMAIL_BACKENDS = (
             ('mybackend',
@@ -532,6 +663,7 @@ class ScheduleAndSendIntegrationTest(TestCase):
         self.assertEqual(0, sent_count)
         self.assertFalse(entry.sent)
         self.assertEqual(entry.thirdparty_reject, 'potato')
+        self.assertEqual(EmailEntry.STATUS_REJECTED, entry.status)
 
     @override_settings(
         CUSTOM_EMAIL_BACKENDS = (
@@ -564,3 +696,37 @@ class ScheduleAndSendIntegrationTest(TestCase):
         self.assertEqual(meta_fields, entry.metadata)
         self.assertEqual('meta1value', email.metadata['meta1'])
         self.assertIn('meta2value', email.metadata['meta2'])
+
+    @override_settings(
+        CUSTOM_EMAIL_BACKENDS = (
+            ('mybackend',
+             'emails.tests.utils.EmailBackendMockSuccess',
+             'emails.tests.utils.ResponseManagerStub'
+            ),
+        ),
+        CUSTOM_DEFAULT_EMAIL_BACKEND = 'mybackend',
+        SENDER_SEND_BATCH_SIZE = 2
+    )
+    def test_send_entries_in_batches(self):
+        EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, world!',
+            plain_template='Hello, world! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+        for i in range(3):
+            schedule('my-test-email', 'es', {})
+
+        send_messages = EmailBackendMockSuccess.send_messages
+        with patch.object(EmailBackendMockSuccess, 'send_messages',
+                          autospec=True, side_effect=send_messages) as mock_send:
+            sent_count = send_entries()
+        self.assertEqual(3, sent_count)
+        self.assertEqual([2, 1], [len(call[0][1]) for call in mock_send.call_args_list])
+        for entry in EmailEntry.objects.all():
+            self.assertEqual(EmailEntry.STATUS_SENT, entry.status)
+            self.assertEqual('348dj38dj28do5jd82', entry.thirdparty_id)
@@ -0,0 +1,125 @@
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from emails.backends import get_backend, close_backends
+from emails.models import EmailEntry
+from emails.throttle import RateLimiter, recipient_domains, throttle_domains
+
+
+class RateLimiterTest(TestCase):
+    def tearDown(self):
+        caches[settings.SENDER_RATE_LIMIT_CACHE].clear()
+
+    @patch('emails.throttle.time')
+    def test_burst_per_window(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        limiter = RateLimiter('test', rate=10, burst=20)
+        self.assertEqual(15, limiter.acquire(15))
+        self.assertEqual(5, limiter.acquire(15))
+        self.assertEqual(0, limiter.acquire(1))
+
+        # Half of the previous window still counts, only what it granted
+        mock_time.time.return_value = 1003.0
+        self.assertEqual(10, limiter.acquire(15))
+
+    @patch('emails.throttle.time')
+    def test_no_double_burst_across_windows(self, mock_time):
+        limiter = RateLimiter('test', rate=10, burst=20)
+        mock_time.time.return_value = 1001.9
+        self.assertEqual(20, limiter.acquire(20))
+        mock_time.time.return_value = 1002.0
+        self.assertEqual(0, limiter.acquire(20))
+        mock_time.time.return_value = 1003.0
+        self.assertEqual(10, limiter.acquire(20))
+
+    @patch('emails.throttle.time')
+    def test_shared_by_key(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        self.assertEqual(10, RateLimiter('test', rate=10).acquire(10))
+        self.assertEqual(0, RateLimiter('test', rate=10).acquire(1))
+        self.assertEqual(1, RateLimiter('other', rate=10).acquire(1))
+
+    @patch('emails.throttle.time')
+    def test_available_takes_none(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        limiter = RateLimiter('test', rate=10, burst=20)
+        self.assertEqual(20, limiter.available())
+        limiter.acquire(15)
+        self.assertEqual(5, limiter.available())
+        self.assertEqual(5, limiter.available())
+
+    @patch('emails.throttle.time')
+    def test_wait_until_granted(self, mock_time):
+        now = [1000.5]
+        mock_time.time.side_effect = lambda: now[0]
+
+        def sleep(seconds):
+            now[0] += seconds
+        mock_time.sleep.side_effect = sleep
+
+        limiter = RateLimiter('test', rate=10, burst=10)
+        self.assertEqual(0, limiter.wait(5))
+        # 5 at once, and 5 more once half of the previous window is over
+        self.assertAlmostEqual(1.0, limiter.wait(10))
+        self.assertAlmostEqual(1001.5, now[0])
+
+
+@override_settings(SENDER_DOMAIN_LIMITS={'gmail.com': {'rate': 1, 'burst': 2}})
+class DomainThrottleTest(TestCase):
+    def tearDown(self):
+        caches[settings.SENDER_RATE_LIMIT_CACHE].clear()
+
+    def test_recipient_domains(self):
+        self.assertEqual(
+            {'gmail.com': 2, 'qdqmedia.com': 1},
+            recipient_domains('Luisa <luisa@Gmail.com>,pepe@gmail.com, ana@qdqmedia.com')
+        )
+        self.assertEqual({}, recipient_domains(''))
+
+    @patch('emails.throttle.time')
+    def test_only_limited_domains_throttled(self, mock_time):
+        mock_time.time.return_value = 1000.5
+        gmail = EmailEntry(recipients='luisa@gmail.com')
+        other = EmailEntry(recipients='luisa@qdqmedia.com')
+
+        self.assertEqual(0, throttle_domains(gmail))
+        self.assertEqual(0, throttle_domains(gmail))
+        self.assertEqual(2.5, throttle_domains(gmail))
+        self.assertEqual(0, throttle_domains(other))
+
+    @override_settings(SENDER_DOMAIN_LIMITS={'gmail.com': {'rate': 1, 'burst': 2},
+                                             'qdqmedia.com': {'rate': 1, 'burst': 1}})
+    @patch('emails.throttle.time')
+    def test_refused_domain_takes_none_from_others(self, mock_time):
+        mock_time.time.return_value = 1000.5
+        both = EmailEntry(recipients='luisa@gmail.com, pepe@qdqmedia.com, ana@qdqmedia.com')
+        self.assertNotEqual(0, throttle_domains(both))
+        self.assertEqual(2, RateLimiter('domain:gmail.com', rate=1, burst=2).available())
+
+
+@override_settings(
+    CUSTOM_EMAIL_BACKENDS = (
+        ('mybackend',
+         'emails.tests.utils.EmailBackendMockSuccess',
+         'emails.tests.utils.ResponseManagerStub',
+         {'rate': 5, 'burst': 10}
+        ),
+        ('freebackend',
+         'emails.tests.utils.EmailBackendMockSuccess',
+         'emails.tests.utils.ResponseManagerStub'
+        ),
+    ),
+    CUSTOM_DEFAULT_EMAIL_BACKEND = 'mybackend'
+)
+class BackendRateLimitTest(TestCase):
+    def tearDown(self):
+        close_backends()
+
+    def test_backend_rate_limit(self):
+        limiter = get_backend('mybackend').limiter
+        self.assertEqual(5, limiter.rate)
+        self.assertEqual(10, limiter.burst)
+        self.assertIsNone(get_backend('freebackend').limiter)
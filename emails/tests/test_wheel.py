@@ -0,0 +1,68 @@
+from django.test import TestCase, override_settings
+
+from emails.models import EmailKind, EmailEntry
+from emails.wheel import TimingWheel, WheelItem
+
+
+@override_settings(SENDER_WHEEL_WINDOW_SECONDS=600, SENDER_SWEEP_SECONDS=30)
+class TimingWheelTest(TestCase):
+    def setUp(self):
+        self.ekind = EmailKind.objects.create(
+            name='my-test-email',
+            language='es',
+            template='Hello, world!',
+            plain_template='Hello, world! soy antiguo',
+            default_sender='trololo@qdqmedia.com',
+            default_recipients='cliente@gemilio.com',
+            default_subject='Email Test',
+            default_reply_to='atecli@qdqmedia.com'
+        )
+
+    def tearDown(self):
+        EmailKind.objects.all().delete()
+        EmailEntry.objects.all().delete()
+
+    def test_items_are_compact(self):
+        self.assertFalse(hasattr(WheelItem(1000, 1), '__dict__'))
+
+    def test_refill_loads_the_window_only(self):
+        self.ekind.generate_entry({'send_at': 1000})
+        soon = self.ekind.generate_entry({'send_at': 1300})
+        self.ekind.generate_entry({'send_at': 1601})
+
+        wheel = TimingWheel()
+        self.assertEqual(1, wheel.refill(1000))
+        self.assertEqual(1300, wheel.next_due_at())
+        self.assertEqual([], wheel.pop_due(1299))
+        self.assertEqual([soon.id], wheel.pop_due(1300))
+        self.assertIsNone(wheel.next_due_at())
+
+    def test_refill_reads_only_the_new_part_of_the_window(self):
+        self.ekind.generate_entry({'send_at': 1300})
+        later = self.ekind.generate_entry({'send_at': 1620})
+
+        wheel = TimingWheel()
+        wheel.refill(1000)
+        self.assertEqual(0, wheel.refill(1010))
+        self.assertEqual(1, wheel.refill(1030))
+        self.assertEqual(2, len(wheel))
+        self.assertEqual([later.id], wheel.pop_due(1620)[1:])
+
+    def test_reschedule_within_loaded_window(self):
+        deferred = EmailEntry(id=1, status=EmailEntry.STATUS_PENDING, due_at=1100)
+        later = EmailEntry(id=2, status=EmailEntry.STATUS_PENDING, due_at=1700)
+        sent = EmailEntry(id=3, status=EmailEntry.STATUS_SENT, due_at=1000)
+
+        wheel = TimingWheel()
+        wheel.reschedule([deferred])
+        self.assertEqual(0, len(wheel))
+        wheel.refill(1000)
+        wheel.reschedule([deferred, later, sent])
+        self.assertEqual([deferred.id], wheel.pop_due(1700))
+
+    def test_pop_due_in_due_order(self):
+        wheel = TimingWheel()
+        wheel.add(3, 1200)
+        wheel.add(1, 1100)
+        wheel.add(2, 1100)
+        self.assertEqual([1, 2, 3], wheel.pop_due(1200))
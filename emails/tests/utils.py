@@ -4,6 +4,8 @@ from django.core.files.uploadedfile import SimpleUploadedFile
 from django.conf import settings
 from django.core.mail.backends.base import BaseEmailBackend
 
+from emails.backends import BaseResponseManager
+
 
 def create_upload_image():
     fixture_path = os.path.join(settings.BASE_DIR, 'emails', 'tests',
@@ -54,7 +56,7 @@ class EmailBackendMockFailure(BaseEmailBackend):
             msg.response_content = None
 
 
-class ResponseManagerStub(object):
+class ResponseManagerStub(BaseResponseManager):
     def process_response(self, email, entry):
         if email.response_content is not None:
             entry.thirdparty_id = email.response_content[0]['id']
@@ -62,6 +64,13 @@ class ResponseManagerStub(object):
         return False
 
 
+class ResponseManagerPlainStub(object):
+    """A response manager not based on BaseResponseManager"""
+    def process_response(self, email, entry):
+        entry.thirdparty_id = email.response_content[0]['id']
+        return True
+
+
 class EmailBackendMockReject(BaseEmailBackend):
     response = None
 
@@ -70,7 +79,7 @@ class EmailBackendMockReject(BaseEmailBackend):
             msg.response_content = [{'rejected_because': 'potato'}]
 
 
-class ResponseManagerRejectStub(object):
+class ResponseManagerRejectStub(BaseResponseManager):
     def process_response(self, email, entry):
         entry.thirdparty_reject = email.response_content[0]['rejected_because']
         return False
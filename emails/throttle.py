@@ -0,0 +1,159 @@
+"""
+Pacing of the sending, shared by all the senders through a Django cache.
+Backends can be limited as a whole, and recipient domains one by one, so
+mail to a busy domain waits while mail to the rest keeps flowing.
+
+A RateLimiter lets `burst` messages through within any `burst / rate`
+seconds, which averages `rate` messages per second. It counts the messages
+of fixed windows that long, and weighs those of the previous window by how
+much of it is still within the last `burst / rate` seconds, so a burst at
+the end of a window and another at the start of the next one do not
+double the rate. Its counters live in the
+`SENDER_RATE_LIMIT_CACHE` cache, so all the senders using a shared cache
+backend respect a single limit. The backend must increment atomically,
+like memcached or Redis do: the database cache reads and then writes
+the counters, so concurrent senders lose each other's counts and send
+over the limit. With the default local memory cache every sender process
+is limited on its own.
+"""
+import math
+import time
+from email.utils import getaddresses
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class RateLimiter(object):
+    """
+    @type key: str identifying the limit among all the senders
+    @type rate: float messages per second
+    @type burst: int messages that can go at once, rate by default
+    """
+
+    def __init__(self, key, rate, burst=None):
+        self.key = key
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.window = self.burst / rate
+
+    def acquire(self, count=1):
+        """
+        Takes up to `count` messages. Returns how many were granted, which
+        may be less, or none, if the limit is reached. Only the messages
+        granted are counted.
+        """
+        cache = caches[settings.SENDER_RATE_LIMIT_CACHE]
+        now = time.time()
+        window = int(now // self.window)
+        key = self._window_key(window)
+        # Counters are still weighed during the next window
+        cache.add(key, 0, math.ceil(2 * self.window) + 1)
+        try:
+            used = cache.incr(key, count)
+        except ValueError:
+            # Expired between add and incr, so the window is over anyway
+            return 0
+        previous = cache.get(self._window_key(window - 1), 0)
+        granted = max(0, min(count, self._room(now, previous, used - count)))
+        if granted < count:
+            # Taken at once and given back, so concurrent senders can only
+            # be refused too much for a moment, never granted too much
+            try:
+                cache.decr(key, count - granted)
+            except ValueError:
+                pass
+        return granted
+
+    def available(self):
+        """How many messages can still be granted, taking none"""
+        now = time.time()
+        previous, current = self._counts(now)
+        return max(0, self._room(now, previous, current))
+
+    def wait(self, count=1):
+        """
+        Blocks until `count` messages are granted, window after window.
+        Returns the seconds it waited.
+        """
+        waited = 0
+        count -= self.acquire(count)
+        while count > 0:
+            delay = self.wait_time(count)
+            time.sleep(delay)
+            waited += delay
+            count -= self.acquire(count)
+        return waited
+
+    def wait_time(self, count=1):
+        """
+        Seconds until `count` messages, up to `burst`, can be granted, as
+        the previous window weighs less and less. Never 0, as it is asked
+        once the limit is reached.
+        """
+        count = min(count, self.burst)
+        now = time.time()
+        previous, current = self._counts(now)
+        elapsed = now % self.window
+        wait = 0
+        if current + count > self.burst:
+            # Not within this window. In the next one, this is the previous.
+            wait = self.window - elapsed
+            previous, current, elapsed = current, 0, 0
+        if previous:
+            # When previous * (1 - elapsed / window) + current + count <= burst
+            needed = self.window * (1 - (self.burst - current - count) / previous)
+            wait += max(needed - elapsed, 0)
+        return max(wait, 0.001)
+
+    def _room(self, now, previous, current):
+        """Messages left, with the previous window weighed by how much still counts"""
+        weight = 1 - now % self.window / self.window
+        return int(self.burst - previous * weight - current)
+
+    def _counts(self, now):
+        """The messages counted in the previous and the current windows"""
+        window = int(now // self.window)
+        keys = [self._window_key(window - 1), self._window_key(window)]
+        counts = caches[settings.SENDER_RATE_LIMIT_CACHE].get_many(keys)
+        return counts.get(keys[0], 0), counts.get(keys[1], 0)
+
+    def _window_key(self, window):
+        return 'throttle:{}:{}'.format(self.key, window)
+
+
+def recipient_domains(recipients):
+    """
+    Returns the domains of the comma separated recipients of an entry,
+    lowercased, with the number of recipients in each of them.
+    """
+    domains = {}
+    for _, address in getaddresses([recipients]):
+        if '@' in address:
+            domain = address.rsplit('@', 1)[1].lower()
+            domains[domain] = domains.get(domain, 0) + 1
+    return domains
+
+
+def throttle_domains(entry):
+    """
+    Takes the messages of the recipients of the entry from the limits of
+    their domains in `SENDER_DOMAIN_LIMITS`. Returns 0 if the entry can be
+    sent, or the seconds to wait for a domain which is over its limit.
+    Every domain is checked before taking from any, so a domain over its
+    limit does not waste the messages of the others.
+    @type entry: EmailEntry
+    """
+    limited = []
+    for domain, count in recipient_domains(entry.recipients).items():
+        limits = settings.SENDER_DOMAIN_LIMITS.get(domain)
+        if limits:
+            limited.append((RateLimiter('domain:{}'.format(domain), **limits), count))
+    for limiter, count in limited:
+        if limiter.available() < count:
+            return limiter.wait_time()
+    for limiter, count in limited:
+        # Another sender may have taken them since they were checked
+        if limiter.acquire(count) < count:
+            return limiter.wait_time()
+    return 0
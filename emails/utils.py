@@ -1,4 +1,7 @@
+import time
 from django.conf import settings
+from django.db.models import Case, When, Value
+from django.utils import timezone
 
 
 def allowed_language_codes():
@@ -8,6 +11,39 @@ def allowed_language_codes():
     return langs
 
 
+def now_timestamp():
+    """Returns the current time as an int timestamp in UTC"""
+    return int(time.mktime(timezone.now().timetuple()))
+
+
+def bulk_update(instances, fields):
+    """
+    Writes the fields of all the instances, of a same model, with a single
+    UPDATE. A field with the same value in every instance is set as is,
+    the others with a CASE on the primary key. Returns the rows updated.
+    @type instances: list of models.Model
+    @type fields: list of field names
+    """
+    if not instances:
+        return 0
+    model = instances[0]._meta.concrete_model
+    values = {}
+    for name in fields:
+        field = model._meta.get_field(name)
+        first = getattr(instances[0], field.attname)
+        if all(getattr(instance, field.attname) == first for instance in instances):
+            values[name] = first
+        else:
+            values[name] = Case(
+                *[When(pk=instance.pk,
+                       then=Value(getattr(instance, field.attname), output_field=field))
+                  for instance in instances],
+                output_field=field
+            )
+    return model.objects.filter(pk__in=[instance.pk for instance in instances])\
+                        .update(**values)
+
+
 def custom_assert(condition, message):
     if not condition:
         raise EmailAssertionError(message)
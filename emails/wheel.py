@@ -0,0 +1,93 @@
+"""
+A timing wheel holding the entries that will be due soon, so the sender can
+send them at their exact second without asking the database again and
+again. It is only a cache of the next `SENDER_WHEEL_WINDOW_SECONDS`: the
+database is still the source of truth, and a restarted sender just loads
+its window again.
+"""
+import heapq
+
+from django.conf import settings
+
+from emails.models import EmailEntry
+
+
+class WheelItem(object):
+    """An entry waiting in the wheel, as small as it can be"""
+    __slots__ = ('due_at', 'entry_id')
+
+    def __init__(self, due_at, entry_id):
+        self.due_at = due_at
+        self.entry_id = entry_id
+
+    def __lt__(self, other):
+        return (self.due_at, self.entry_id) < (other.due_at, other.entry_id)
+
+
+class TimingWheel(object):
+    """
+    A heap of WheelItem ordered by due time. The window already loaded
+    from the database is remembered, so every refill only reads the
+    entries that became due within the moving window since the last one.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self.loaded_until = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, entry_id, due_at):
+        heapq.heappush(self._heap, WheelItem(due_at, entry_id))
+
+    def refill(self, now_ts):
+        """
+        Loads the pending entries due after `now_ts` within the window and
+        not loaded yet. Returns how many were loaded.
+        @type now_ts: int timestamp in UTC
+        """
+        window_end = now_ts + settings.SENDER_WHEEL_WINDOW_SECONDS
+        if self.loaded_until is None or self.loaded_until < now_ts:
+            start = now_ts
+        elif window_end - self.loaded_until < settings.SENDER_SWEEP_SECONDS:
+            # Not worth a query yet, the window has barely moved
+            return 0
+        else:
+            start = self.loaded_until
+
+        rows = EmailEntry.objects.filter(status=EmailEntry.STATUS_PENDING)\
+                                 .filter(due_at__gt=start)\
+                                 .filter(due_at__lte=window_end)\
+                                 .filter(kind__active=True)\
+                                 .values_list('id', 'due_at')
+        count = 0
+        for entry_id, due_at in rows.iterator():
+            self.add(entry_id, due_at)
+            count += 1
+        self.loaded_until = window_end
+        return count
+
+    def reschedule(self, entries):
+        """
+        Adds the entries given back pending, like the deferred or retried
+        ones, if due again within the window already loaded, as no refill
+        reads that part again. Those due later are loaded by a refill.
+        @type entries: list of EmailEntry
+        """
+        if self.loaded_until is None:
+            return
+        for entry in entries:
+            if entry.status == EmailEntry.STATUS_PENDING and entry.due_at <= self.loaded_until:
+                self.add(entry.id, entry.due_at)
+
+    def pop_due(self, now_ts):
+        """Takes out of the wheel the ids of the entries due at `now_ts`"""
+        ids = []
+        while self._heap and self._heap[0].due_at <= now_ts:
+            ids.append(heapq.heappop(self._heap).entry_id)
+        return ids
+
+    def next_due_at(self):
+        """Due time of the next entry in the wheel, or None if it is empty"""
+        return self._heap[0].due_at if self._heap else None
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 
 BASE_DIR = os.path.realpath(os.path.join(os.path.dirname(
     os.path.dirname(__file__)), '..')
@@ -186,6 +187,7 @@ RABBITMQ_PASSWORD = 'guest'
 RABBITMQ_CONNECTION_ATTEMPTS = 3
 RABBITMQ_EMAIL_EXCHANGE = 'root'
 RABBITMQ_ENQUEUE_EMAIL_QUEUE = 'enqueue-email'
+RABBITMQ_SEND_EMAIL_QUEUE = 'send-email'
 RABBITMQ_PASSIVE = True
 RABBITMQ_HEARTBEAT_INTERVAL = 10
 
@@ -197,6 +199,77 @@ REST_FRAMEWORK = {
 
 # Sender job
 SENDER_ELLAPSED_SECONDS = 0.5
+# With push enabled, scheduled entries due now are announced through
+# RABBITMQ_SEND_EMAIL_QUEUE and senders wait on it instead of polling every
+# SENDER_ELLAPSED_SECONDS, sweeping the database every SENDER_SWEEP_SECONDS.
+SENDER_PUSH_ENABLED = False
+SENDER_SWEEP_SECONDS = 30
+# With push enabled, entries due within this many seconds are also kept in
+# a timing wheel by the senders, which send them at their exact second.
+SENDER_WHEEL_WINDOW_SECONDS = 10 * 60
+# Entries claimed by a sender on every run, and for how long the claim
+# holds before other senders can take them over.
+SENDER_BATCH_SIZE = 100
+SENDER_LEASE_SECONDS = 5 * 60
+# Claimed entries that were not sent, like those their origin denied, are
+# pending again after this delay, so they do not hold back the others
+SENDER_RELEASE_DELAY_SECONDS = 60
+# Emails handed to a backend in a single send_messages call.
+SENDER_SEND_BATCH_SIZE = 20
+# Backend connections idle for longer are closed instead of reused, before
+# the server drops them and the next batch sent through them fails.
+SENDER_CONNECTION_IDLE_SECONDS = 60
+# Share of every claim taken by the entries of each EmailKind priority. The
+# share a priority does not use goes to the others, the heaviest first.
+SENDER_PRIORITY_WEIGHTS = {
+    'transactional': 6,
+    'normal': 3,
+    'bulk': 1,
+}
+# Threads sending the claimed entries in parallel. 1 sends them one by one.
+SENDER_CONCURRENCY = 1
+# With adaptive concurrency, SENDER_CONCURRENCY is the most groups sent at
+# once. Fewer are sent, down to SENDER_CONCURRENCY_MIN, while the backends
+# take more than SENDER_LATENCY_TARGET seconds per email or fail more than
+# SENDER_MAX_ERROR_RATE of the emails.
+SENDER_ADAPTIVE_CONCURRENCY = False
+SENDER_CONCURRENCY_MIN = 1
+SENDER_LATENCY_TARGET = 1.0
+SENDER_MAX_ERROR_RATE = 0.1
+# Cache holding the rate limit counters of the backends with a rate. Use a
+# cache shared by all the senders to share the limit, with atomic
+# increments, like memcached or Redis. The database cache is not atomic.
+SENDER_RATE_LIMIT_CACHE = 'default'
+# Rate limits, like those of the backends, for the recipients of a domain:
+# {'gmail.com': {'rate': 10, 'burst': 20}}. Entries for a domain over its
+# limit are deferred, and the entries for other domains are sent meanwhile.
+SENDER_DOMAIN_LIMITS = {}
+# Failed entries are retried after SENDER_RETRY_BACKOFF_SECONDS, doubled
+# on every further failure up to SENDER_RETRY_BACKOFF_MAX_SECONDS, and
+# quarantined after SENDER_MAX_ATTEMPTS failures.
+SENDER_RETRY_BACKOFF_SECONDS = 60
+SENDER_RETRY_BACKOFF_MAX_SECONDS = 6 * 60 * 60
+SENDER_MAX_ATTEMPTS = 8
+
+# Checks of the entries check_url before sending them. Timeout in seconds
+# of every check, checks made at the same time, and at most to one host.
+ORIGIN_CHECK_TIMEOUT = 5
+ORIGIN_CHECK_CONCURRENCY = 10
+ORIGIN_CHECK_MAX_PER_HOST = 4
+# Entries asked about in a single request to a batch check url.
+ORIGIN_CHECK_BATCH_SIZE = 500
+# Cache where the answers to the checks are kept, and for how many seconds
+# depending on the answer. A Cache-Control max-age in the answer wins.
+ORIGIN_CHECK_CACHE = 'default'
+ORIGIN_CHECK_CACHE_TTL = {
+    'allowed': 10,
+    'denied': 60,
+    'error': 30,
+}
+# Failures in a row after which the checks to a host are skipped, and for
+# how many seconds, before trying that host again.
+ORIGIN_BREAKER_FAILURES = 5
+ORIGIN_BREAKER_COOLDOWN = 60
 
 # Cleaner job
 CLEANER_ELLAPSED_SECONDS = 5 * 60
@@ -223,7 +296,31 @@ METRIC = {
     'SEND_FAIL': 'send.result.fail',
     'SEND_IS_SPAM': 'send.spam',
     'SEND_ATTACHS': 'send.attachs',
+    'SEND_RECLAIMED': 'send.reclaimed',
+    'SEND_RETRY': 'send.retry',
+    'SEND_QUARANTINED': 'send.quarantined',
+    'SEND_THROTTLED': 'send.throttled',
+    'SEND_DEFERRED': 'send.deferred',
+    'SEND_CONCURRENCY_LIMIT': 'send.concurrency.limit',
+
+    'ORIGIN_CACHE_HIT': 'origin.cache.hit',
+    'ORIGIN_CACHE_MISS': 'origin.cache.miss',
+    'ORIGIN_BREAKER_OPEN': 'origin.breaker.open',
+    'ORIGIN_BREAKER_HOST': 'origin.breaker.host',
 }
 
-# HTML minification
+# HTML minification, of the templates when they are compiled
 MINIFY_HTML = True
+
+# Render the entries when they are scheduled instead of when they are sent.
+# The sender reuses them as long as their kind does not change.
+RENDER_ON_SCHEDULE = False
+# Compiled templates of kinds and fragments kept in memory by every process
+RENDER_TEMPLATE_CACHE_SIZE = 500
+# Compiled templates are also stored here, and shared by all the processes
+# of the node that run as the same user. It is created only accessible to
+# that user, and not used if anyone else can access it. None to disable it.
+RENDER_BYTECODE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'leela-templates')
+# Compile the templates of every active kind and fragment when the web
+# workers and the sender start
+RENDER_WARM_UP = False
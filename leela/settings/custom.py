@@ -22,6 +22,7 @@ RABBITMQ_PASSWORD = 'guest'
 RABBITMQ_CONNECTION_ATTEMPTS = 3
 RABBITMQ_EMAIL_EXCHANGE = 'root'
 RABBITMQ_ENQUEUE_EMAIL_QUEUE = 'enqueue-email'
+RABBITMQ_SEND_EMAIL_QUEUE = 'send-email'
 RABBITMQ_PASSIVE = True
 RABBITMQ_HEARTBEAT_INTERVAL = 10
 
@@ -39,6 +39,7 @@ RABBITMQ_PASSWORD = 'guest'
 RABBITMQ_CONNECTION_ATTEMPTS = 1
 RABBITMQ_EMAIL_EXCHANGE = 'root'
 RABBITMQ_ENQUEUE_EMAIL_QUEUE = 'enqueue-email'
+RABBITMQ_SEND_EMAIL_QUEUE = 'send-email'
 RABBITMQ_PASSIVE = False
 
 STATSD_ENABLED = False
@@ -43,6 +43,7 @@ RABBITMQ_PASSWORD = os.getenv('RABBITMQ_PASSWORD', '')
 RABBITMQ_CONNECTION_ATTEMPTS = 3
 RABBITMQ_EMAIL_EXCHANGE = 'root'
 RABBITMQ_ENQUEUE_EMAIL_QUEUE = 'email_leela'
+RABBITMQ_SEND_EMAIL_QUEUE = 'email_leela_send'
 RABBITMQ_PASSIVE = True
 
 STATSD_ENABLED = True
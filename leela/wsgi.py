@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "leela.settings")
 
 application = get_wsgi_application()
+
+from django.conf import settings  # noqa
+if settings.RENDER_WARM_UP:
+    from emails.render import warm_up_templates  # noqa
+    warm_up_templates()